@@ -1,9 +1,9 @@
 """The ESP Simple Devices integration."""
 from __future__ import annotations
 
-from homeassistant.config_entries import ConfigEntry
-from homeassistant.const import Platform
-from homeassistant.core import HomeAssistant
+from homeassistant.config_entries import ConfigEntry, ConfigEntryState
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP, Platform
+from homeassistant.core import CALLBACK_TYPE, Event, HomeAssistant
 from .socket_server import ESPSimpleSocketServer
 from homeassistant.components import zeroconf
 from zeroconf.asyncio import AsyncServiceInfo
@@ -13,16 +13,46 @@ from .espsimple import *
 
 import socket
 
-from .const import DOMAIN
+from .const import CONF_DECODE_WORKERS, CONF_UDP_LISTENER, DOMAIN, UDP_PORT
 
 # TODO List the platforms that you want to support.
 # For your initial PR, limit it to 1 platform.
 PLATFORMS: list[Platform] = [Platform.SENSOR]
 
 __SOCKET_SERVER__: ESPSimpleSocketServer | None = None
+__SERVICE_INFO__: AsyncServiceInfo | None = None
+__STOP_LISTENER__: CALLBACK_TYPE | None = None
+
+
+def get_socket_server() -> ESPSimpleSocketServer | None:
+    """Get the running socket server."""
+    return __SOCKET_SERVER__
+
+
+def decode_workers(hass: HomeAssistant) -> int:
+    """Get the decode workers of the socket server, the largest any entry sets."""
+    return max(
+        (
+            int(e.options.get(CONF_DECODE_WORKERS, 0))
+            for e in hass.config_entries.async_entries(DOMAIN)
+        ),
+        default=0,
+    )
+
+
+def udp_port(hass: HomeAssistant) -> int | None:
+    """Get the datagram port of the socket server, if any entry turns it on."""
+    if any(
+        e.options.get(CONF_UDP_LISTENER, False)
+        for e in hass.config_entries.async_entries(DOMAIN)
+    ):
+        return UDP_PORT
+    return None
 
 
 async def register_service(hass: HomeAssistant):
+    global __SERVICE_INFO__
+
     aiozc = await zeroconf.async_get_async_instance(hass)
     ip_list = await async_get_enabled_source_ips(hass)
 
@@ -34,29 +64,101 @@ async def register_service(hass: HomeAssistant):
         properties={},
     )
     await aiozc.async_register_service(info)
+    __SERVICE_INFO__ = info
+
+
+async def unregister_service(hass: HomeAssistant):
+    global __SERVICE_INFO__
+
+    if __SERVICE_INFO__ is None:
+        return
+
+    aiozc = await zeroconf.async_get_async_instance(hass)
+    await aiozc.async_unregister_service(__SERVICE_INFO__)
+    __SERVICE_INFO__ = None
+
+
+async def stop_socket_server() -> None:
+    """Stop the socket server, draining its connections."""
+    global __SOCKET_SERVER__, __STOP_LISTENER__
+
+    if __STOP_LISTENER__ is not None:
+        __STOP_LISTENER__()
+        __STOP_LISTENER__ = None
+
+    if __SOCKET_SERVER__ is not None:
+        server = __SOCKET_SERVER__
+        __SOCKET_SERVER__ = None
+        await server.async_stop()
 
 
 async def async_setup_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Set up ESP Simple Devices from a config entry."""
-    global __SOCKET_SERVER__
+    global __SOCKET_SERVER__, __STOP_LISTENER__
+
+    await ESPSimpleStorage.async_load(hass)
 
     if __SOCKET_SERVER__ is None:
-        __SOCKET_SERVER__ = ESPSimpleSocketServer(hass)
-        __SOCKET_SERVER__.start()
+        __SOCKET_SERVER__ = ESPSimpleSocketServer(
+            hass, udp_port=udp_port(hass), decode_workers=decode_workers(hass)
+        )
+        try:
+            await __SOCKET_SERVER__.async_start()
+        except OSError:
+            # Let the next setup start the server again
+            __SOCKET_SERVER__ = None
+            raise
         await register_service(hass)
 
+        async def async_stop(event: Event) -> None:
+            """Stop the socket server when Home Assistant stops."""
+            global __STOP_LISTENER__
+
+            # Fired once, removing the listener again would fail
+            __STOP_LISTENER__ = None
+            await stop_socket_server()
+
+        __STOP_LISTENER__ = hass.bus.async_listen_once(
+            EVENT_HOMEASSISTANT_STOP, async_stop
+        )
+
     await hass.config_entries.async_forward_entry_setups(entry, PLATFORMS)
+    entry.async_on_unload(entry.add_update_listener(async_update_options))
 
     return True
 
 
+async def async_update_options(hass: HomeAssistant, entry: ConfigEntry) -> None:
+    """Apply changed options without reloading the entry."""
+    device = ESPSimpleDeviceRegistry.get_device(entry.data["device_id"])
+    if device is not None:
+        device.configure_filters(dict(entry.options))
+        if __SOCKET_SERVER__ is not None:
+            __SOCKET_SERVER__.push_config(device)
+
+    if __SOCKET_SERVER__ is not None:
+        await __SOCKET_SERVER__.async_set_decode_workers(decode_workers(hass))
+        await __SOCKET_SERVER__.async_set_udp_port(udp_port(hass))
+
+
 async def async_unload_entry(hass: HomeAssistant, entry: ConfigEntry) -> bool:
     """Unload a config entry."""
+    global __SOCKET_SERVER__
+
     if unload_ok := await hass.config_entries.async_unload_platforms(entry, PLATFORMS):
         device = ESPSimpleDeviceRegistry.get_device(entry.data["device_id"])
         ESPSimpleDeviceRegistry.remove_device(entry.data["device_id"])
         device.remove_all_sensors()
-
-    ESPSimpleStorage.set_devices(ESPSimpleDeviceRegistry.device_list)
+        ESPSimpleStorage.async_schedule_remove(hass, entry.data["device_id"], 0)
+
+    remaining = [
+        e
+        for e in hass.config_entries.async_entries(DOMAIN)
+        if e.entry_id != entry.entry_id and e.state is ConfigEntryState.LOADED
+    ]
+    if unload_ok and not remaining and __SOCKET_SERVER__ is not None:
+        await unregister_service(hass)
+        await stop_socket_server()
+        await ESPSimpleStorage.async_unload(hass)
 
     return unload_ok
@@ -0,0 +1,39 @@
+"""ESP Simple Devices admission control"""
+import math
+
+
+class ESPSimpleRateLimit:
+    """Token bucket limiting the update frames of one device
+
+    The bucket holds up to burst tokens and refills at rate tokens per
+    second, every update frame takes one. A rate of 0 disables the limit.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "last_time", "limited")
+
+    def __init__(self, rate: float, burst: float) -> None:
+        self.rate: float = rate
+        self.burst: float = burst
+        self.tokens: float = burst
+        self.last_time: float | None = None
+        self.limited: int = 0
+
+    def take(self, now: float) -> float:
+        """Takes a token, returns 0 or the seconds until one is available"""
+        if not self.rate:
+            return 0
+        if self.last_time is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.last_time) * self.rate
+            )
+        self.last_time = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        self.limited += 1
+        return (1 - self.tokens) / self.rate
+
+
+def retry_after_seconds(seconds: float) -> bytes:
+    """Encodes the wait of an ACK_RETRY_AFTER, whole seconds rounded up"""
+    return min(max(math.ceil(seconds), 1), 0xFFFF).to_bytes(2, "little")
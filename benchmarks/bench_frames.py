@@ -0,0 +1,215 @@
+"""Fuzz and performance checks for the frame decoder and sessions
+
+Run with: python benchmarks/bench_frames.py
+"""
+
+import os
+import random
+import struct
+import time
+
+from common import load_integration
+
+load_integration()
+
+from espsimple.const import (  # noqa: E402
+    FRAME_AUTH_HELLO,
+    FRAME_AUTH_PROOF,
+    FRAME_BATCH_UPDATE,
+    FRAME_HANDLE_BATCH_UPDATE,
+    FRAME_HANDLE_UPDATE,
+    FRAME_KEEPALIVE,
+    FRAME_MANIFEST,
+    FRAME_REGISTRATION,
+    FRAME_SEALED,
+    FRAME_TYPED_BATCH_UPDATE,
+    FRAME_TYPED_UPDATE,
+    FRAME_UPDATE,
+    VALUE_BOOL,
+    VALUE_FLOAT32,
+    VALUE_INT32,
+    VALUE_STRING,
+)
+from espsimple.protocol import ESPSimpleFrameDecoder, FrameError  # noqa: E402
+from espsimple.session import (  # noqa: E402
+    DEVICE_TO_SERVER,
+    ESPSimpleSession,
+    ESPSimpleSessionKeys,
+)
+
+FUZZ_ROUNDS = 20000
+PERF_FRAMES = 100000
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return len(data).to_bytes(4, "little") + data
+
+
+def sample_frames() -> list:
+    """One frame of every type"""
+    registration = [encode_string(v) for v in ("dev", "t", "Temp", "°C", "", "x")]
+    return [
+        bytes([FRAME_REGISTRATION]) + b"".join(registration),
+        bytes([FRAME_UPDATE])
+        + encode_string("dev")
+        + encode_string("t")
+        + encode_string("21.5"),
+        bytes([FRAME_KEEPALIVE]),
+        bytes([FRAME_BATCH_UPDATE])
+        + encode_string("dev")
+        + (2).to_bytes(4, "little")
+        + encode_string("a")
+        + encode_string("1")
+        + encode_string("b")
+        + encode_string("2"),
+        bytes([FRAME_TYPED_UPDATE])
+        + encode_string("dev")
+        + encode_string("t")
+        + bytes([VALUE_FLOAT32])
+        + struct.pack("<f", 21.5),
+        bytes([FRAME_TYPED_BATCH_UPDATE])
+        + encode_string("dev")
+        + (3).to_bytes(4, "little")
+        + encode_string("a")
+        + bytes([VALUE_INT32])
+        + struct.pack("<i", -1)
+        + encode_string("b")
+        + bytes([VALUE_BOOL, 1])
+        + encode_string("c")
+        + bytes([VALUE_STRING])
+        + encode_string("on"),
+        bytes([FRAME_HANDLE_UPDATE])
+        + (1).to_bytes(4, "little")
+        + bytes([VALUE_FLOAT32])
+        + struct.pack("<f", 21.5),
+        bytes([FRAME_HANDLE_BATCH_UPDATE])
+        + (2).to_bytes(4, "little")
+        + (1).to_bytes(4, "little")
+        + bytes([VALUE_FLOAT32])
+        + struct.pack("<f", 21.5)
+        + (2).to_bytes(4, "little")
+        + bytes([VALUE_BOOL, 0]),
+        bytes([FRAME_AUTH_HELLO]) + encode_string("dev"),
+        bytes([FRAME_AUTH_PROOF]) + bytes(range(16)) + bytes(range(32)),
+        bytes([FRAME_SEALED]) + (20).to_bytes(4, "little") + bytes(range(20)),
+        bytes([FRAME_MANIFEST])
+        + encode_string("dev")
+        + (2).to_bytes(4, "little")
+        + b"".join(registration[1:])
+        + b"".join(encode_string(v) for v in ("h", "Hum", "%", "", "x")),
+    ]
+
+
+def decode_all(decoder: ESPSimpleFrameDecoder, data: bytes, chunk: int) -> list:
+    """Feeds data in chunks, collecting every decoded frame"""
+    frames = list()
+    for pos in range(0, len(data), chunk):
+        decoder.feed(data[pos : pos + chunk])
+        while (frame := decoder.next_frame()) is not None:
+            frames.append(frame)
+    return frames
+
+
+def check_fragmentation() -> None:
+    """Every split of a frame stream decodes to the same frames"""
+    data = b"".join(sample_frames())
+    expected = decode_all(ESPSimpleFrameDecoder(), data, len(data))
+    assert len(expected) == len(sample_frames()), expected
+    for chunk in range(1, len(data) + 1):
+        assert decode_all(ESPSimpleFrameDecoder(), data, chunk) == expected, chunk
+    print("fragmentation: ok")
+
+
+def check_limits() -> None:
+    """Oversized length prefixes fail before any allocation"""
+    decoder = ESPSimpleFrameDecoder(max_field_size=16, max_frame_size=64)
+    decoder.feed(bytes([FRAME_UPDATE]) + (0xFFFFFFFF).to_bytes(4, "little"))
+    try:
+        decoder.next_frame()
+    except FrameError:
+        pass
+    else:
+        raise AssertionError("oversized field accepted")
+
+    decoder = ESPSimpleFrameDecoder(max_field_size=16, max_frame_size=64)
+    decoder.feed(bytes([FRAME_BATCH_UPDATE]) + encode_string("dev"))
+    decoder.feed((1000).to_bytes(4, "little") + encode_string("a") * 10)
+    try:
+        decoder.next_frame()
+    except FrameError:
+        pass
+    else:
+        raise AssertionError("oversized batch accepted")
+    print("limits: ok")
+
+
+def fuzz() -> None:
+    """Mutated and random input only ever fails with FrameError"""
+    rng = random.Random(8901)
+    frames = sample_frames()
+    decoded = failed = 0
+    for _ in range(FUZZ_ROUNDS):
+        data = bytearray(b"".join(rng.choices(frames, k=rng.randint(1, 4))))
+        for _ in range(rng.randint(0, 4)):
+            data[rng.randrange(len(data))] = rng.randrange(256)
+        if rng.random() < 0.2:
+            data = bytearray(rng.randbytes(rng.randint(1, 64)))
+        decoder = ESPSimpleFrameDecoder(max_field_size=64, max_frame_size=256)
+        try:
+            decoded += len(decode_all(decoder, bytes(data), rng.randint(1, 32)))
+        except FrameError:
+            failed += 1
+        assert decoder.pending() <= 256 + 32, decoder.pending()
+    print(f"fuzz: ok, {decoded} frames decoded, {failed} streams rejected")
+
+
+def perf() -> None:
+    """Decoding throughput with typical TCP segment sizes"""
+    frames = sample_frames()
+    data = b"".join(frames[i % len(frames)] for i in range(PERF_FRAMES))
+    for chunk in (64, 1460, 16 * 1024):
+        decoder = ESPSimpleFrameDecoder()
+        start = time.perf_counter()
+        count = len(decode_all(decoder, data, chunk))
+        elapsed = time.perf_counter() - start
+        print(
+            f"perf: {chunk:>6} byte reads, {count / elapsed:>9.0f} frames/s, "
+            f"{elapsed / count * 1e6:.2f} us/frame"
+        )
+
+
+def perf_sessions() -> None:
+    """Cost of opening a session and of every sealed frame"""
+    keys = ESPSimpleSessionKeys(b"0123456789abcdef")
+    start = time.perf_counter()
+    for _ in range(10000):
+        server_nonce, client_nonce = os.urandom(16), os.urandom(16)
+        keys.verify_proof(
+            server_nonce, client_nonce, keys.proof(server_nonce, client_nonce)
+        )
+        session = ESPSimpleSession(keys, server_nonce, client_nonce)
+    elapsed = time.perf_counter() - start
+    print(f"sessions: {elapsed / 10000 * 1e6:.2f} us/handshake")
+
+    frame = sample_frames()[6]
+    # Records as the device seals them
+    device = ESPSimpleSession(keys, server_nonce, client_nonce)
+    records = list()
+    for counter in range(PERF_FRAMES):
+        nonce = DEVICE_TO_SERVER + counter.to_bytes(8, "little")
+        records.append(device.aead.encrypt(nonce, frame, None))
+    start = time.perf_counter()
+    for record in records:
+        session.open(record)
+        session.seal(b"\x01")
+    elapsed = time.perf_counter() - start
+    print(f"sessions: {elapsed / PERF_FRAMES * 1e6:.2f} us/frame to open and ack")
+
+
+if __name__ == "__main__":
+    check_fragmentation()
+    check_limits()
+    fuzz()
+    perf()
+    perf_sessions()
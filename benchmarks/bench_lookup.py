@@ -0,0 +1,57 @@
+"""Micro-benchmark for device and sensor lookups on the update path
+
+Run with: python benchmarks/bench_lookup.py
+"""
+
+import timeit
+
+from common import load_integration
+
+load_integration()
+
+from espsimple.espsimple import (  # noqa: E402
+    ESPSimpleDevice,
+    ESPSimpleDeviceRegistry,
+    ESPSimpleSensor,
+    ESPSimpleSensorInfo,
+)
+
+SENSORS_PER_DEVICE = 10
+SIZES = (10, 100, 1000, 10000)
+LOOKUPS = 100000
+
+
+def build_registry(sensor_count: int) -> list:
+    """Fills the registry, returns the (device_id, sensor_id) pairs"""
+    ESPSimpleDeviceRegistry.devices.clear()
+    keys = list()
+    for d in range(max(1, sensor_count // SENSORS_PER_DEVICE)):
+        device = ESPSimpleDevice("device" + str(d), "Device", "model", "1.0", None)
+        ESPSimpleDeviceRegistry.add_device(device)
+        for s in range(min(sensor_count, SENSORS_PER_DEVICE)):
+            info = ESPSimpleSensorInfo(
+                "Sensor", "sensor" + str(s), device, "", "", "measurement"
+            )
+            device.add_sensor(ESPSimpleSensor(None, info))
+            keys.append((device.device_id, info.unique_id))
+    return keys
+
+
+def lookup(keys: list) -> None:
+    """Resolves every key the way handle_update does"""
+    for device_id, sensor_id in keys:
+        ESPSimpleDeviceRegistry.get_device(device_id).get_sensor(sensor_id)
+
+
+def main() -> None:
+    print("sensors    ns/lookup")
+    for size in SIZES:
+        keys = build_registry(size)
+        # Same number of lookups for every size, spread over all sensors
+        keys = (keys * (LOOKUPS // len(keys) + 1))[:LOOKUPS]
+        best = min(timeit.repeat(lambda: lookup(keys), number=1, repeat=5))
+        print(f"{size:>7}    {best / LOOKUPS * 1e9:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
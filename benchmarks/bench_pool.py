@@ -0,0 +1,164 @@
+"""Socket server throughput with and without decode workers
+
+The server runs in this process, simulated devices in a separate client
+process, each keeping a connection and sending typed batch updates in
+pipelined windows. Reports the throughput and the CPU time the server
+process spends per frame, which is what limits the event loop. Decode
+workers run in their own processes and are not counted there.
+
+Run with: python benchmarks/bench_pool.py --workers 0 2 4
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import struct
+import tempfile
+import time
+
+from common import load_integration
+
+load_integration()
+
+from espsimple.const import (  # noqa: E402
+    FRAME_KEEPALIVE,
+    FRAME_TYPED_BATCH_UPDATE,
+    VALUE_FLOAT32,
+)
+from espsimple.espsimple import (  # noqa: E402
+    ESPSimpleDevice,
+    ESPSimpleDeviceRegistry,
+    ESPSimpleSensor,
+)
+from espsimple.metrics import ESPSimpleMetrics  # noqa: E402
+from espsimple.persistent_storage import ESPSimpleStorage  # noqa: E402
+from espsimple.socket_server import ESPSimpleSocketServer  # noqa: E402
+
+from load_test import (  # noqa: E402
+    HOST,
+    Fleet,
+    StubEntityPlatform,
+    StubHass,
+    encode_string,
+    write_ha_state,
+)
+
+
+def batch_frame(device_id: str, sensor_ids: list, value: float) -> bytes:
+    frame = bytearray([FRAME_TYPED_BATCH_UPDATE])
+    frame += encode_string(device_id)
+    frame += len(sensor_ids).to_bytes(4, "little")
+    for sensor_id in sensor_ids:
+        frame += encode_string(sensor_id)
+        frame += bytes([VALUE_FLOAT32]) + struct.pack("<f", value)
+    return bytes(frame)
+
+
+async def device(port: int, device_id: str, sensor_ids: list, args) -> int:
+    """Sends rounds of updates in windows, waiting for the acks of each"""
+    reader, writer = await asyncio.open_connection(HOST, port)
+    writer.write(bytes([FRAME_KEEPALIVE]))
+    await reader.readexactly(1)
+    frames = 0
+    for start in range(0, args.frames, args.window):
+        count = min(args.window, args.frames - start)
+        writer.write(
+            b"".join(
+                batch_frame(device_id, sensor_ids, float(start + i))
+                for i in range(count)
+            )
+        )
+        await reader.readexactly(count)
+        frames += count
+    writer.close()
+    return frames
+
+
+def run_clients(port: int, args, results) -> None:
+    """Client process, simulating the whole fleet"""
+    sensor_ids = ["s" + str(s) for s in range(args.sensors)]
+
+    async def run() -> None:
+        counts = await asyncio.gather(
+            *(
+                device(port, "bench" + str(d), sensor_ids, args)
+                for d in range(args.devices)
+            )
+        )
+        results.put(sum(counts))
+
+    asyncio.run(run())
+
+
+async def measure(args, workers: int) -> dict:
+    ESPSimpleDeviceRegistry.devices.clear()
+    ESPSimpleMetrics.reset()
+    with tempfile.TemporaryDirectory() as config_dir:
+        os.makedirs(os.path.join(config_dir, ".storage"))
+        hass = StubHass(asyncio.get_running_loop(), config_dir)
+        platform = StubEntityPlatform(hass)
+        await ESPSimpleStorage.async_load(hass)
+        server = ESPSimpleSocketServer(
+            hass, HOST, args.port, udp_port=None, decode_workers=workers
+        )
+        await server.async_start()
+        for d in range(args.devices):
+            device = ESPSimpleDevice(
+                "bench" + str(d), "bench" + str(d), "bench", "1.0", platform
+            )
+            # Measure decoding, not admission control
+            device.rate_limit.rate = 0
+            ESPSimpleDeviceRegistry.add_device(device)
+        fleet = Fleet(args.port, args.devices, args.sensors, 100)
+        await fleet.register_manifests()
+
+        results = multiprocessing.get_context("spawn").Queue()
+        clients = multiprocessing.get_context("spawn").Process(
+            target=run_clients, args=(args.port, args, results)
+        )
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        clients.start()
+        frames = await hass.loop.run_in_executor(None, results.get)
+        elapsed = time.perf_counter() - start
+        cpu = time.process_time() - cpu_start
+        await hass.loop.run_in_executor(None, clients.join)
+
+        await server.async_stop()
+        await ESPSimpleStorage.async_unload(hass)
+
+    return {
+        "workers": workers,
+        "frames": frames,
+        "frames_per_second": frames / elapsed,
+        "server_cpu_us": cpu / frames * 1e6,
+        "batches": ESPSimpleMetrics.counters.get("pool_batches", 0),
+        "buffers": ESPSimpleMetrics.counters.get("pool_buffers", 0),
+    }
+
+
+async def main(args) -> None:
+    ESPSimpleSensor.async_write_ha_state = write_ha_state
+    print("cpus:", os.cpu_count())
+    print(
+        f"{'workers':>7} {'frames':>8} {'frames/s':>9} {'cpu us/frame':>12} "
+        f"{'batches':>8} {'buffers':>8}"
+    )
+    for workers in args.workers:
+        result = await measure(args, workers)
+        print(
+            f"{result['workers']:>7} {result['frames']:>8} "
+            f"{result['frames_per_second']:>9.0f} {result['server_cpu_us']:>12.1f} "
+            f"{result['batches']:>8} {result['buffers']:>8}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, nargs="+", default=[0, 2, 4])
+    parser.add_argument("--devices", type=int, default=200)
+    parser.add_argument("--sensors", type=int, default=20)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--window", type=int, default=20)
+    parser.add_argument("--port", type=int, default=18911)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,128 @@
+"""Startup time of restoring devices and sensors from storage
+
+Writes a storage file for fleets of growing size, then sets up one config
+entry per device concurrently, the way Home Assistant does at boot.
+
+Run with: python benchmarks/bench_startup.py
+"""
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+
+from common import load_integration
+
+load_integration()
+
+from homeassistant.helpers import entity_platform as ep  # noqa: E402
+
+from espsimple import sensor  # noqa: E402
+from espsimple.espsimple import (  # noqa: E402
+    ESPSimpleDeviceRegistry,
+    ESPSimpleSensor,
+)
+from espsimple.metrics import ESPSimpleMetrics  # noqa: E402
+from espsimple.persistent_storage import ESPSimpleStorage  # noqa: E402
+from espsimple.state_log import ESPSimpleStateLog  # noqa: E402
+
+from load_test import StubEntityPlatform, StubHass, write_ha_state  # noqa: E402
+
+
+def write_storage(config_dir: str, devices: int, sensors: int) -> None:
+    handle = 0
+    states = dict()
+    device_list = list()
+    for d in range(devices):
+        sensor_list = list()
+        for s in range(sensors):
+            handle += 1
+            sensor_list.append(
+                {
+                    "name": "Sensor " + str(s),
+                    "unique_id": "s" + str(s),
+                    "unit_of_measurement": "°C",
+                    "device_class": "temperature",
+                    "state_class": "measurement",
+                    "handle": handle,
+                }
+            )
+            states[handle] = 21.5
+        device_list.append(
+            {
+                "device_id": "bench" + str(d),
+                "friendly_name": "bench" + str(d),
+                "model": "bench",
+                "sw_version": "1.0",
+                "sensors": sensor_list,
+            }
+        )
+    os.makedirs(os.path.join(config_dir, ".storage"))
+    with open(
+        os.path.join(config_dir, ".storage", "espsimple.json"), "w", encoding="utf-8"
+    ) as f:
+        json.dump({"devices": device_list}, f)
+    with open(os.path.join(config_dir, ".storage", "espsimple.states"), "wb") as f:
+        f.write(ESPSimpleStateLog.encode(states))
+
+
+async def setup_entry(hass: StubHass, entry) -> None:
+    """Sets up the sensor platform of one entry with its own entity platform"""
+    platform = StubEntityPlatform(hass)
+    ep.current_platform.set(platform)
+    added = list()
+    await sensor.async_setup_entry(hass, entry, added.extend)
+    await platform.async_add_entities(added)
+
+
+async def run(devices: int, sensors: int) -> dict:
+    ESPSimpleDeviceRegistry.devices.clear()
+    ESPSimpleMetrics.reset()
+    with tempfile.TemporaryDirectory() as config_dir:
+        write_storage(config_dir, devices, sensors)
+        hass = StubHass(asyncio.get_running_loop(), config_dir)
+        entries = [
+            SimpleNamespace(
+                title="bench" + str(d),
+                data={"device_id": "bench" + str(d), "model": "m", "sw_version": "1"},
+                options=dict(),
+                disabled_by=None,
+            )
+            for d in range(devices)
+        ]
+        hass.config_entries = SimpleNamespace(async_entries=lambda domain: entries)
+
+        start = time.perf_counter()
+        await asyncio.gather(*(setup_entry(hass, entry) for entry in entries))
+        elapsed = time.perf_counter() - start
+        await ESPSimpleStorage.async_unload(hass)
+
+    startup = ESPSimpleMetrics.startup
+    return {
+        "devices": devices,
+        "sensors": startup["sensors"],
+        "total_ms": elapsed * 1000,
+        "storage_load_ms": startup["storage_load"] * 1000,
+        "per_device_us": elapsed / devices * 1e6,
+    }
+
+
+async def main(args) -> None:
+    ESPSimpleSensor.async_write_ha_state = write_ha_state
+    print(f"{'devices':>8} {'sensors':>8} {'total ms':>9} {'load ms':>8} {'us/dev':>7}")
+    for devices in args.devices:
+        result = await run(devices, args.sensors)
+        print(
+            f"{result['devices']:>8} {result['sensors']:>8} "
+            f"{result['total_ms']:>9.1f} {result['storage_load_ms']:>8.1f} "
+            f"{result['per_device_us']:>7.0f}"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--devices", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--sensors", type=int, default=5)
+    asyncio.run(main(parser.parse_args()))
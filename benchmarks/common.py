@@ -0,0 +1,27 @@
+"""Shared helpers for the ESP Simple Devices benchmarks"""
+
+import importlib.util
+import os
+import sys
+
+INTEGRATION_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_integration():
+    """Imports the integration as the espsimple package
+
+    The integration normally lives in custom_components/espsimple, the
+    benchmarks import it straight from the checkout instead.
+    """
+    if "espsimple" in sys.modules:
+        return sys.modules["espsimple"]
+
+    spec = importlib.util.spec_from_file_location(
+        "espsimple",
+        os.path.join(INTEGRATION_DIR, "__init__.py"),
+        submodule_search_locations=[INTEGRATION_DIR],
+    )
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["espsimple"] = module
+    spec.loader.exec_module(module)
+    return module
@@ -0,0 +1,381 @@
+"""Load test for the socket server with a simulated ESP device fleet
+
+The server runs on a local event loop against a stub Home Assistant with
+its own state machine and a temporary config directory. Simulated devices
+speak the wire protocol over real TCP connections.
+
+Run with: python benchmarks/load_test.py --scenario all
+"""
+
+import argparse
+import asyncio
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from common import load_integration
+
+load_integration()
+
+from espsimple.const import (  # noqa: E402
+    ACK_RETRY_AFTER,
+    FRAME_BATCH_UPDATE,
+    FRAME_KEEPALIVE,
+    FRAME_MANIFEST,
+    FRAME_REGISTRATION,
+    FRAME_UPDATE,
+)
+from espsimple.espsimple import (  # noqa: E402
+    ESPSimpleDevice,
+    ESPSimpleDeviceRegistry,
+    ESPSimpleSensor,
+)
+from espsimple.metrics import ESPSimpleMetrics  # noqa: E402
+from espsimple.persistent_storage import ESPSimpleStorage  # noqa: E402
+from espsimple.socket_server import ESPSimpleSocketServer  # noqa: E402
+
+HOST = "127.0.0.1"
+SCENARIOS = ("steady", "churn", "large", "registration_storm", "manifest_storm")
+
+
+class StubStates:
+    """Local state machine"""
+
+    def __init__(self) -> None:
+        self.states: dict = dict()
+        self.writes: int = 0
+
+    def get(self, entity_id: str):
+        return self.states.get(entity_id)
+
+    def async_set(self, entity_id: str, state, attributes=None, **kwargs) -> None:
+        self.writes += 1
+        self.states[entity_id] = SimpleNamespace(
+            state=state, attributes=attributes or dict()
+        )
+
+
+class StubHass:
+    """The parts of HomeAssistant used by the integration"""
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, config_dir: str) -> None:
+        self.loop = loop
+        self.config = SimpleNamespace(config_dir=config_dir)
+        self.data: dict = {"core.uuid": "benchmark"}
+        self.states = StubStates()
+        self.bus = SimpleNamespace(async_listen_once=lambda *args: lambda: None)
+
+    def async_add_executor_job(self, target, *args):
+        return self.loop.run_in_executor(None, target, *args)
+
+    def async_create_task(self, target, *args, **kwargs):
+        return self.loop.create_task(target)
+
+
+class StubEntityPlatform:
+    """Adds entities to the stub state machine"""
+
+    def __init__(self, hass: StubHass) -> None:
+        self.hass = hass
+
+    async def async_add_entities(self, entities) -> None:
+        for entity in entities:
+            entity.hass = self.hass
+            entity.entity_id = "sensor." + entity.unique_id
+            entity.async_write_pending_state()
+
+
+def write_ha_state(sensor: ESPSimpleSensor) -> None:
+    """Replaces Entity.async_write_ha_state, writes to the stub state machine"""
+    sensor.hass.states.async_set(sensor.entity_id, sensor.native_value)
+
+
+def encode_string(value: str) -> bytes:
+    data = value.encode("utf-8")
+    return len(data).to_bytes(4, "little") + data
+
+
+def registration_frame(device_id: str, sensor_id: str) -> bytes:
+    return (
+        bytes([FRAME_REGISTRATION])
+        + encode_string(device_id)
+        + encode_string(sensor_id)
+        + encode_string("Sensor " + sensor_id)
+        + encode_string("°C")
+        + encode_string("measurement")
+        + encode_string("temperature")
+    )
+
+
+def manifest_frame(device_id: str, sensor_ids: list) -> bytes:
+    frame = bytearray([FRAME_MANIFEST])
+    frame += encode_string(device_id)
+    frame += len(sensor_ids).to_bytes(4, "little")
+    for sensor_id in sensor_ids:
+        frame += encode_string(sensor_id) + encode_string("Sensor " + sensor_id)
+        frame += encode_string("°C") + encode_string("measurement")
+        frame += encode_string("temperature")
+    return bytes(frame)
+
+
+def update_frame(device_id: str, sensor_id: str, state: str) -> bytes:
+    return (
+        bytes([FRAME_UPDATE])
+        + encode_string(device_id)
+        + encode_string(sensor_id)
+        + encode_string(state)
+    )
+
+
+def batch_update_frame(device_id: str, states: dict) -> bytes:
+    frame = bytearray([FRAME_BATCH_UPDATE])
+    frame += encode_string(device_id)
+    frame += len(states).to_bytes(4, "little")
+    for sensor_id, state in states.items():
+        frame += encode_string(sensor_id) + encode_string(state)
+    return bytes(frame)
+
+
+class Fleet:
+    """Simulated devices and the measurements taken while they run"""
+
+    def __init__(self, port: int, devices: int, sensors: int, concurrency: int):
+        self.port = port
+        self.device_ids = ["bench" + str(d) for d in range(devices)]
+        self.sensor_ids = ["s" + str(s) for s in range(sensors)]
+        self.connection_limit = asyncio.Semaphore(concurrency)
+        self.latencies: list = list()
+        self.frames: int = 0
+        self.errors: int = 0
+        self.retries: int = 0
+
+    async def exchange(self, frames: list, keep_alive: bool, ack_size: int = 1) -> None:
+        """Sends frames on one connection, measuring the time until each ack"""
+        async with self.connection_limit:
+            try:
+                reader, writer = await asyncio.open_connection(HOST, self.port)
+            except OSError:
+                self.errors += 1
+                return
+            try:
+                if keep_alive:
+                    writer.write(bytes([FRAME_KEEPALIVE]))
+                    await reader.readexactly(1)
+                for frame in frames:
+                    start = time.perf_counter()
+                    writer.write(frame)
+                    ack = await reader.readexactly(1)
+                    if ack[0] == ACK_RETRY_AFTER:
+                        # Dropped by admission control, not retried
+                        await reader.readexactly(2)
+                        self.retries += 1
+                        continue
+                    await reader.readexactly(ack_size - 1)
+                    self.latencies.append(time.perf_counter() - start)
+                    self.frames += 1
+            except (OSError, asyncio.IncompleteReadError):
+                self.errors += 1
+            finally:
+                writer.close()
+
+    async def register_all(self) -> None:
+        """Every device registers all of its sensors"""
+        await asyncio.gather(
+            *(
+                self.exchange([registration_frame(d, s) for s in self.sensor_ids], True)
+                for d in self.device_ids
+            )
+        )
+
+    async def register_manifests(self) -> None:
+        """Every device registers all of its sensors with one manifest"""
+        await asyncio.gather(
+            *(
+                self.exchange(
+                    [manifest_frame(d, self.sensor_ids)],
+                    True,
+                    1 + 4 * len(self.sensor_ids),
+                )
+                for d in self.device_ids
+            )
+        )
+
+    async def steady(self, rounds: int) -> None:
+        """Every device keeps one connection and reports sensor by sensor"""
+        await asyncio.gather(
+            *(
+                self.exchange(
+                    [
+                        update_frame(d, s, str(r))
+                        for r in range(rounds)
+                        for s in self.sensor_ids
+                    ],
+                    True,
+                )
+                for d in self.device_ids
+            )
+        )
+
+    async def churn(self, rounds: int) -> None:
+        """Legacy devices, one connection per reading"""
+        await asyncio.gather(
+            *(
+                self.exchange([update_frame(d, s, str(r))], False)
+                for r in range(rounds)
+                for d in self.device_ids
+                for s in self.sensor_ids
+            )
+        )
+
+    async def large(self, rounds: int) -> None:
+        """Every device reports all sensors in one batch per round"""
+        await asyncio.gather(
+            *(
+                self.exchange(
+                    [
+                        batch_update_frame(d, {s: str(r) for s in self.sensor_ids})
+                        for r in range(rounds)
+                    ],
+                    True,
+                )
+                for d in self.device_ids
+            )
+        )
+
+
+def percentile(values: list, fraction: float) -> float:
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_scenario(args, scenario: str) -> dict:
+    """Runs one scenario against a fresh server"""
+    ESPSimpleDeviceRegistry.devices.clear()
+    ESPSimpleMetrics.reset()
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        os.makedirs(os.path.join(config_dir, ".storage"))
+        hass = StubHass(asyncio.get_running_loop(), config_dir)
+        platform = StubEntityPlatform(hass)
+
+        await ESPSimpleStorage.async_load(hass)
+        server = ESPSimpleSocketServer(
+            hass,
+            HOST,
+            args.port,
+            udp_port=args.port,
+            decode_workers=args.decode_workers,
+        )
+        await server.async_start()
+
+        for device_id in ["bench" + str(d) for d in range(args.devices)]:
+            ESPSimpleDeviceRegistry.add_device(
+                ESPSimpleDevice(device_id, device_id, "bench", "1.0", platform)
+            )
+
+        fleet = Fleet(args.port, args.devices, args.sensors, args.concurrency)
+        if args.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+
+        if scenario == "registration_storm":
+            await fleet.register_all()
+            # Everybody reboots and registers again at once
+            await fleet.register_all()
+        elif scenario == "manifest_storm":
+            await fleet.register_manifests()
+            await fleet.register_manifests()
+        else:
+            await fleet.register_all()
+            fleet.latencies.clear()
+            fleet.frames = 0
+            start = time.perf_counter()
+            await getattr(fleet, scenario)(args.rounds)
+
+        elapsed = time.perf_counter() - start
+        peak_memory = 0
+        if args.trace_memory:
+            _, peak_memory = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+        await server.async_stop()
+        await ESPSimpleStorage.async_unload(hass)
+
+    return {
+        "scenario": scenario,
+        "frames": fleet.frames,
+        "errors": fleet.errors,
+        "retries": fleet.retries,
+        "seconds": elapsed,
+        "frames_per_second": fleet.frames / elapsed if elapsed else 0,
+        "p50_ms": percentile(fleet.latencies, 0.5) * 1000,
+        "p99_ms": percentile(fleet.latencies, 0.99) * 1000,
+        "peak_memory_mb": peak_memory / 1024 / 1024,
+        "state_writes": hass.states.writes,
+        "storage_writes": ESPSimpleMetrics.counters.get("storage_writes", 0),
+        "state_log_writes": ESPSimpleMetrics.counters.get("state_log_writes", 0),
+    }
+
+
+# Title, result key, column width and format of the result table
+COLUMNS = (
+    ("scenario", "scenario", 20, ""),
+    ("frames", "frames", 8, ""),
+    ("errors", "errors", 7, ""),
+    ("retries", "retries", 8, ""),
+    ("frames/s", "frames_per_second", 9, ".0f"),
+    ("p50 ms", "p50_ms", 8, ".2f"),
+    ("p99 ms", "p99_ms", 8, ".2f"),
+    ("mem MB", "peak_memory_mb", 7, ".1f"),
+    ("states", "state_writes", 7, ""),
+    ("storage", "storage_writes", 8, ""),
+    ("log", "state_log_writes", 5, ""),
+)
+
+
+def print_results(results: list) -> None:
+    print(" ".join(f"{title:>{width}}" for title, _, width, _ in COLUMNS))
+    for result in results:
+        print(
+            " ".join(f"{result[key]:>{width}{fmt}}" for _, key, width, fmt in COLUMNS)
+        )
+    print("max rss MB:", resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024)
+
+
+async def main(args) -> None:
+    ESPSimpleSensor.async_write_ha_state = write_ha_state
+    ESPSimpleStorage.save_delay = args.save_delay
+
+    scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+    results = list()
+    for scenario in scenarios:
+        results.append(await run_scenario(args, scenario))
+    print_results(results)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="all")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--sensors", type=int, default=5)
+    parser.add_argument("--rounds", type=int, default=5)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--save-delay", type=float, default=1.0)
+    parser.add_argument("--port", type=int, default=18901)
+    parser.add_argument(
+        "--decode-workers",
+        type=int,
+        default=0,
+        help="decode frames in this many worker processes",
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="report the peak of traced allocations, slows the run down",
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -1,30 +1,58 @@
 """Config flow for ESP Simple Devices integration."""
 from __future__ import annotations
 
+import asyncio
 import logging
 import json
-import random
+import os
+import secrets
 import string
 from typing import Any
 
+import aiohttp
 import voluptuous as vol
-import requests
 
 from homeassistant.components import zeroconf
 from homeassistant import config_entries
-from homeassistant.core import HomeAssistant
-from homeassistant.data_entry_flow import FlowResult
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.data_entry_flow import FlowResult, FlowResultType
 from homeassistant.exceptions import HomeAssistantError
+from homeassistant.helpers.aiohttp_client import async_get_clientsession
+import homeassistant.helpers.config_validation as cv
 
 from homeassistant.const import (
     CONF_HOST,
     CONF_PORT,
 )
 
-from .const import DOMAIN
+from .const import (
+    BULK_ADOPT_CONCURRENCY,
+    CONF_ABSOLUTE_DELTA,
+    CONF_DECODE_WORKERS,
+    CONF_MAX_INTERVAL,
+    CONF_MIN_INTERVAL,
+    CONF_RELATIVE_DELTA,
+    CONF_REPORT_DEADBAND,
+    CONF_REPORT_INTERVAL,
+    CONF_REQUIRE_AUTHENTICATION,
+    CONF_SENSORS,
+    CONF_UDP_LISTENER,
+    DISCOVERED,
+    DOMAIN,
+    HTTP_ATTEMPTS,
+    HTTP_CONNECT_TIMEOUT,
+    HTTP_READ_TIMEOUT,
+    HTTP_RETRY_DELAY,
+)
+from .persistent_storage import ESPSimpleStorage
+from .update_filter import filter_settings, reporting_settings
 
 _LOGGER = logging.getLogger(__name__)
 
+HTTP_TIMEOUT = aiohttp.ClientTimeout(
+    sock_connect=HTTP_CONNECT_TIMEOUT, sock_read=HTTP_READ_TIMEOUT
+)
+
 # TODO adjust the data schema to the data that you need
 STEP_USER_DATA_SCHEMA = vol.Schema(
     {
@@ -33,6 +61,32 @@ STEP_USER_DATA_SCHEMA = vol.Schema(
 )
 
 
+def filter_schema(settings: dict) -> vol.Schema:
+    """Form for update filter and reporting settings"""
+    return vol.Schema(
+        {
+            vol.Required(
+                CONF_ABSOLUTE_DELTA, default=settings.get(CONF_ABSOLUTE_DELTA, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(
+                CONF_RELATIVE_DELTA, default=settings.get(CONF_RELATIVE_DELTA, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(
+                CONF_MIN_INTERVAL, default=settings.get(CONF_MIN_INTERVAL, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(
+                CONF_MAX_INTERVAL, default=settings.get(CONF_MAX_INTERVAL, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+            vol.Required(
+                CONF_REPORT_INTERVAL, default=settings.get(CONF_REPORT_INTERVAL, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0, max=4294967)),
+            vol.Required(
+                CONF_REPORT_DEADBAND, default=settings.get(CONF_REPORT_DEADBAND, 0)
+            ): vol.All(vol.Coerce(float), vol.Range(min=0)),
+        }
+    )
+
+
 class PlaceholderHub:
     """Placeholder class to make tests pass.
 
@@ -73,14 +127,37 @@ async def validate_input(hass: HomeAssistant, flow: ConfigFlow):
     # InvalidAuth
 
 
-def get_device_info(flow: ConfigFlow):
+async def device_request(
+    hass: HomeAssistant, method: str, url: str, **kwargs: Any
+) -> tuple[int, bytes]:
+    """Sends a request to a device, returns the status and the body
+
+    Uses the shared client session, so connections to the device are reused.
+    Failed connections and server errors are retried with backoff.
+    """
+    session = async_get_clientsession(hass)
+    for attempt in range(HTTP_ATTEMPTS):
+        try:
+            async with session.request(
+                method, url, timeout=HTTP_TIMEOUT, **kwargs
+            ) as response:
+                body = await response.read()
+                if response.status < 500 or attempt == HTTP_ATTEMPTS - 1:
+                    return response.status, body
+        except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+            if attempt == HTTP_ATTEMPTS - 1:
+                raise CannotConnect from err
+        await asyncio.sleep(HTTP_RETRY_DELAY * 2**attempt)
+
+
+async def get_device_info(flow: ConfigFlow):
     url = "http://" + flow.host + ":" + str(flow.port) + "/info"
-    info = requests.get(url, timeout=10)
+    status, content = await device_request(flow.hass, "GET", url)
 
-    if info.status_code != 200:
+    if status != 200:
         return None
 
-    data_str = info.content.decode("utf-8")
+    data_str = content.decode("utf-8")
     infojson = json.loads(data_str)
 
     if "friendly_name" in infojson:
@@ -94,11 +171,11 @@ def get_device_info(flow: ConfigFlow):
 def get_random_string(length) -> str:
     # choose from all lowercase letter
     letters = string.ascii_lowercase
-    result_str = "".join(random.choice(letters) for i in range(length))
+    result_str = "".join(secrets.choice(letters) for i in range(length))
     return result_str
 
 
-def adopt_device(flow: ConfigFlow):
+async def adopt_device(flow: ConfigFlow):
     flow.info = flow.info
     flow.config = {
         "encryption_key": get_random_string(16),
@@ -111,18 +188,52 @@ def adopt_device(flow: ConfigFlow):
         "friendly_name": flow.name,
     }
     url = "http://" + flow.host + ":" + str(flow.port) + "/adopt"
-    response = requests.post(
+    status, _ = await device_request(
+        flow.hass,
+        "POST",
         url,
         data={
             "ha_instance": flow.hass.data["core.uuid"],
             "key": flow.config["encryption_key"],
         },
-        timeout=10,
     )
-    if response.status_code != 200:
-        flow.errors["base"] = "Could not adopt device. Code: " + str(
-            response.status_code
-        )
+    if status != 200:
+        flow.errors["base"] = "Could not adopt device. Code: " + str(status)
+
+
+class PendingAdoption:
+    """A discovered device adopted by the bulk adoption step
+
+    Has the attributes of ConfigFlow used by get_device_info and adopt_device.
+    """
+
+    def __init__(self, hass: HomeAssistant, discovery: dict) -> None:
+        self.hass: HomeAssistant = hass
+        self.host: str = discovery[CONF_HOST]
+        self.port: int = discovery[CONF_PORT]
+        self.device_name: str = discovery["device_name"]
+        self.name: str = discovery["name"]
+        self.info: Any = None
+        self.config: Any = None
+        self.errors: dict = dict()
+
+
+async def adopt_discovered(
+    adoption: PendingAdoption, limit: asyncio.Semaphore
+) -> str | None:
+    """Queries and adopts a discovered device, returns the error if it failed"""
+    async with limit:
+        try:
+            await get_device_info(adoption)
+            if adoption.info is None:
+                return "no_info"
+            await adopt_device(adoption)
+        except CannotConnect:
+            return "cannot_connect"
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.exception("Unexpected exception adopting %s", adoption.host)
+            return "unknown"
+    return adoption.errors.get("base")
 
 
 class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
@@ -130,6 +241,14 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
 
     VERSION = 1
 
+    @staticmethod
+    @callback
+    def async_get_options_flow(
+        config_entry: config_entries.ConfigEntry,
+    ) -> OptionsFlowHandler:
+        """Get the options flow for this handler."""
+        return OptionsFlowHandler(config_entry)
+
     def __init__(self) -> None:
         """Initialize flow."""
         self.host: str | None = None
@@ -169,7 +288,7 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             _LOGGER.exception("Unexpected exception")
             errors["base"] = "unknown"
         else:
-            await self.hass.async_add_executor_job(adopt_device, self)
+            await adopt_device(self)
             return self.async_create_entry(title=self.name, data=self.config)
 
         return self.async_show_form(
@@ -191,7 +310,14 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
                 description_placeholders={"name": self.name},
             )
 
-        await self.hass.async_add_executor_job(get_device_info, self)
+        try:
+            await get_device_info(self)
+        except CannotConnect:
+            return self.async_show_form(
+                step_id="discovery_confirm",
+                description_placeholders={"name": self.name},
+                errors={"base": "cannot_connect"},
+            )
 
         return await self.async_step_device_settings()
 
@@ -214,15 +340,114 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             updates={CONF_HOST: self.host, CONF_PORT: self.port}
         )
 
+        # Offered for bulk adoption until the device is configured
+        domain_data = self.hass.data.setdefault(DOMAIN, dict())
+        domain_data.setdefault(DISCOVERED, dict())[device_name] = {
+            CONF_HOST: self.host,
+            CONF_PORT: self.port,
+            "device_name": device_name,
+            "name": self.name,
+        }
+
         return await self.async_step_discovery_confirm()
 
+    def pending_discoveries(self) -> dict:
+        """Gets the discovered devices that are not configured yet"""
+        discovered = self.hass.data.get(DOMAIN, dict()).get(DISCOVERED, dict())
+        configured = self._async_current_ids()
+        for device_name in [d for d in discovered if d in configured]:
+            del discovered[device_name]
+        return discovered
+
     async def async_step_user(
         self, user_input: dict[str, Any] | None = None
     ) -> FlowResult:
         """Handle the initial step."""
+        if self.pending_discoveries():
+            return self.async_show_menu(
+                step_id="user", menu_options=["bulk_select", "manual"]
+            )
+        return await self.async_step_manual(user_input)
+
+    async def async_step_bulk_select(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Adopt many discovered devices at once."""
+        discovered = self.pending_discoveries()
+        if user_input is None:
+            devices = {
+                device_name: discovery["name"] + " (" + discovery[CONF_HOST] + ")"
+                for device_name, discovery in discovered.items()
+            }
+            return self.async_show_form(
+                step_id="bulk_select",
+                data_schema=vol.Schema(
+                    {
+                        vol.Required(
+                            "devices", default=list(devices)
+                        ): cv.multi_select(devices)
+                    }
+                ),
+            )
+
+        adoptions = [
+            PendingAdoption(self.hass, discovered[d])
+            for d in user_input["devices"]
+            if d in discovered
+        ]
+        if not adoptions:
+            return self.async_abort(reason="no_devices")
+
+        limit = asyncio.Semaphore(BULK_ADOPT_CONCURRENCY)
+        errors = await asyncio.gather(
+            *(adopt_discovered(adoption, limit) for adoption in adoptions)
+        )
+        adopted = [i for i, error in enumerate(errors) if error is None]
+        created = await asyncio.gather(
+            *(
+                self.hass.config_entries.flow.async_init(
+                    DOMAIN,
+                    context={"source": "bulk_import"},
+                    data=adoptions[i].config,
+                )
+                for i in adopted
+            )
+        )
+        for i, result in zip(adopted, created):
+            if result["type"] == FlowResultType.CREATE_ENTRY:
+                discovered.pop(adoptions[i].device_name, None)
+            else:
+                errors[i] = result.get("reason") or "not_created"
+
+        results = [
+            "- " + adoption.name + ": " + (error or "adopted")
+            for adoption, error in zip(adoptions, errors)
+        ]
+        return self.async_abort(
+            reason="bulk_adopted",
+            description_placeholders={
+                "adopted": str(errors.count(None)),
+                "total": str(len(adoptions)),
+                "results": "\n".join(results),
+            },
+        )
+
+    async def async_step_bulk_import(self, data: dict[str, Any]) -> FlowResult:
+        """Create the entry of a device adopted by the bulk adoption step."""
+        # The discovery flows of the device are aborted once the entry exists
+        await self.async_set_unique_id(data["device_name"], raise_on_progress=False)
+        self._abort_if_unique_id_configured(
+            updates={CONF_HOST: data[CONF_HOST], CONF_PORT: data[CONF_PORT]}
+        )
+        return self.async_create_entry(title=data["friendly_name"], data=data)
+
+    async def async_step_manual(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Handle adding a device by host."""
         if user_input is None:
             return self.async_show_form(
-                step_id="user", data_schema=vol.Schema({vol.Required("host"): str})
+                step_id="manual", data_schema=vol.Schema({vol.Required("host"): str})
             )
 
         # Hostname is format: livingroom.local.
@@ -233,11 +458,10 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
         self.host = device_name
         self.port = 8901
 
-        await self.hass.async_add_executor_job(get_device_info, self)
-
         errors = {}
 
         try:
+            await get_device_info(self)
             await validate_input(self.hass, self)
         except CannotConnect:
             errors["base"] = "cannot_connect"
@@ -250,7 +474,122 @@ class ConfigFlow(config_entries.ConfigFlow, domain=DOMAIN):
             return await self.async_step_device_settings()
 
         return self.async_show_form(
-            step_id="user", data_schema=STEP_USER_DATA_SCHEMA, errors=errors
+            step_id="manual", data_schema=STEP_USER_DATA_SCHEMA, errors=errors
+        )
+
+
+class OptionsFlowHandler(config_entries.OptionsFlow):
+    """Handle update filter and security options of a device."""
+
+    def __init__(self, config_entry: config_entries.ConfigEntry) -> None:
+        """Initialize options flow."""
+        self.config_entry = config_entry
+        self.options: dict[str, Any] = dict(config_entry.options)
+        self.sensor_id: str | None = None
+
+    async def async_step_init(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Choose between device, sensor and security settings."""
+        return self.async_show_menu(
+            step_id="init",
+            menu_options=["device_filter", "sensor_select", "security", "performance"],
+        )
+
+    async def async_step_device_filter(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Handle the update filter defaults of the device."""
+        if user_input is not None:
+            self.options.update(user_input)
+            return self.async_create_entry(title="", data=self.options)
+
+        return self.async_show_form(
+            step_id="device_filter", data_schema=filter_schema(self.options)
+        )
+
+    async def async_step_security(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Handle whether the device has to authenticate."""
+        if user_input is not None:
+            self.options.update(user_input)
+            return self.async_create_entry(title="", data=self.options)
+
+        return self.async_show_form(
+            step_id="security",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(
+                        CONF_REQUIRE_AUTHENTICATION,
+                        default=self.options.get(CONF_REQUIRE_AUTHENTICATION, False),
+                    ): bool
+                }
+            ),
+        )
+
+    async def async_step_performance(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Handle the decode workers and datagram listener of the socket server."""
+        if user_input is not None:
+            self.options.update(user_input)
+            return self.async_create_entry(title="", data=self.options)
+
+        return self.async_show_form(
+            step_id="performance",
+            data_schema=vol.Schema(
+                {
+                    vol.Required(
+                        CONF_DECODE_WORKERS,
+                        default=self.options.get(CONF_DECODE_WORKERS, 0),
+                    ): vol.All(
+                        vol.Coerce(int), vol.Range(min=0, max=os.cpu_count() or 1)
+                    ),
+                    vol.Required(
+                        CONF_UDP_LISTENER,
+                        default=self.options.get(CONF_UDP_LISTENER, False),
+                    ): bool,
+                }
+            ),
+        )
+
+    async def async_step_sensor_select(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Choose the sensor to override the update filter for."""
+        if user_input is not None:
+            self.sensor_id = user_input["sensor"]
+            return await self.async_step_sensor_filter()
+
+        device = ESPSimpleStorage.get_device(self.config_entry.data["device_id"])
+        sensors = {
+            s["unique_id"]: s["name"] for s in (device or dict()).get("sensors", [])
+        }
+        if not sensors:
+            return self.async_abort(reason="no_sensors")
+
+        return self.async_show_form(
+            step_id="sensor_select",
+            data_schema=vol.Schema({vol.Required("sensor"): vol.In(sensors)}),
+        )
+
+    async def async_step_sensor_filter(
+        self, user_input: dict[str, Any] | None = None
+    ) -> FlowResult:
+        """Handle the update filter of a single sensor."""
+        if user_input is not None:
+            sensors = dict(self.options.get(CONF_SENSORS, dict()))
+            sensors[self.sensor_id] = user_input
+            self.options[CONF_SENSORS] = sensors
+            return self.async_create_entry(title="", data=self.options)
+
+        settings = filter_settings(self.options, self.sensor_id)
+        settings.update(reporting_settings(self.options, self.sensor_id))
+        return self.async_show_form(
+            step_id="sensor_filter",
+            data_schema=filter_schema(settings),
+            description_placeholders={"sensor": self.sensor_id},
         )
 
 
@@ -1,3 +1,150 @@
 """Constants for the ESP Simple Devices integration."""
 
 DOMAIN = "espsimple"
+
+# Maximum number of device connections handled at the same time, further
+# connections are turned away with ACK_RETRY_AFTER
+MAX_CONNECTIONS = 256
+# Connections the kernel queues until they are accepted
+ACCEPT_BACKLOG = 128
+# Seconds devices turned away for the connection limit or a full ingest
+# queue are told to wait
+OVERLOAD_RETRY_AFTER = 5
+
+# Update frames per second and burst allowed per device, over TCP and UDP
+DEVICE_RATE_LIMIT = 20
+DEVICE_RATE_BURST = 100
+
+# Sensors with a state waiting to be applied before update frames are
+# turned away. Further updates of a waiting sensor replace its state.
+INGEST_QUEUE_SIZE = 10000
+
+# Seconds state changes are collected before storage is written
+STORAGE_SAVE_DELAY = 10
+
+# The last state log is compacted once it is larger than both this many
+# bytes and the factor times its size after the last compaction
+STATE_LOG_COMPACT_SIZE = 64 * 1024
+STATE_LOG_COMPACT_FACTOR = 4
+
+# Seconds a device connection may stay silent before it is closed
+IDLE_TIMEOUT = 60
+# Seconds connections get on shutdown to handle the frames already received
+DRAIN_TIMEOUT = 5
+
+# Frame types sent by devices, first byte of every frame
+FRAME_REGISTRATION = 0
+FRAME_UPDATE = 1
+# Switches the connection to keep-alive: frames are read until the device
+# disconnects or stays idle, each frame is acked in the order it was sent
+FRAME_KEEPALIVE = 2
+# One device id followed by a count and that many sensor id / state pairs
+FRAME_BATCH_UPDATE = 3
+# Like FRAME_UPDATE and FRAME_BATCH_UPDATE with typed instead of string states
+FRAME_TYPED_UPDATE = 4
+FRAME_TYPED_BATCH_UPDATE = 5
+# Registration acked with ACK_OK followed by the 4 byte handle of the sensor
+FRAME_HANDLE_REGISTRATION = 6
+# Typed updates addressing sensors by handle instead of device and sensor id
+FRAME_HANDLE_UPDATE = 7
+FRAME_HANDLE_BATCH_UPDATE = 8
+# Opens an encrypted session: the device id, acked with ACK_OK followed by
+# a SESSION_NONCE_SIZE byte server nonce
+FRAME_AUTH_HELLO = 9
+# The device's nonce followed by its HMAC-SHA256 proof of the adopted key,
+# acked with ACK_OK. Everything sent afterwards, acks included, is sealed
+FRAME_AUTH_PROOF = 10
+# 4 byte length followed by one frame encrypted with the session key
+FRAME_SEALED = 11
+# Registers all sensors of a device: the device id, a count and that many
+# sensor id, name, unit, state class and device class strings. Acked with
+# ACK_OK followed by the 4 byte handles of the sensors in frame order
+FRAME_MANIFEST = 12
+
+# Sent by the server on connections that sent FRAME_CONFIG_REQUEST, between
+# acks: a count and that many sensor id strings, each followed by the 4
+# byte little endian report interval in milliseconds and the 8 byte float
+# report deadband. The empty sensor id holds the device defaults, 0 leaves
+# a setting to the device. Sent once the connection is known to belong to a
+# device with reporting settings and again whenever they change.
+FRAME_CONFIG = 13
+# Opens a datagram epoch: the device id, acked with ACK_OK followed by a
+# DATAGRAM_EPOCH_SIZE byte random epoch. Datagrams are signed over the
+# epoch and their sequence numbers count up within it. Epochs end when the
+# device opens a new one and when Home Assistant restarts.
+FRAME_DATAGRAM_EPOCH = 14
+# Asks for FRAME_CONFIG: the device id, acked with ACK_OK. Makes the
+# connection keep-alive, the reporting settings follow the ack.
+FRAME_CONFIG_REQUEST = 15
+
+SESSION_NONCE_SIZE = 16
+DATAGRAM_EPOCH_SIZE = 16
+
+# Tags of typed states, followed by the little endian value
+VALUE_STRING = 0
+VALUE_FLOAT32 = 1
+VALUE_FLOAT64 = 2
+VALUE_INT32 = 3
+VALUE_INT64 = 4
+VALUE_BOOL = 5
+
+# Ack codes sent back to devices
+ACK_OK = 1
+# A handle is not known (anymore), the device has to register again
+ACK_UNKNOWN_HANDLE = 2
+# The device is not known, has no key or failed to prove it knows the key
+ACK_AUTH_FAILED = 3
+# The server is overloaded or the device sends too fast. Followed by the 2
+# byte little endian number of seconds to wait before sending again, the
+# frame was dropped
+ACK_RETRY_AFTER = 4
+
+# Options for filtering incoming updates, per device with per sensor overrides
+CONF_ABSOLUTE_DELTA = "absolute_delta"
+CONF_RELATIVE_DELTA = "relative_delta"
+CONF_MIN_INTERVAL = "min_interval"
+CONF_MAX_INTERVAL = "max_interval"
+CONF_SENSORS = "sensors"
+FILTER_OPTIONS = (
+    CONF_ABSOLUTE_DELTA,
+    CONF_RELATIVE_DELTA,
+    CONF_MIN_INTERVAL,
+    CONF_MAX_INTERVAL,
+)
+
+# Reporting settings pushed to devices, per device with per sensor overrides
+CONF_REPORT_INTERVAL = "report_interval"
+CONF_REPORT_DEADBAND = "report_deadband"
+
+# Worker processes decoding frames for the socket server, shared by all
+# devices, the largest setting of any device wins
+CONF_DECODE_WORKERS = "decode_workers"
+
+# Whether the socket server accepts update datagrams on UDP_PORT, shared by
+# all devices, on as soon as any device turns it on
+CONF_UDP_LISTENER = "udp_listener"
+UDP_PORT = 8901
+
+# Only accept frames of the device over encrypted sessions and signed datagrams
+CONF_REQUIRE_AUTHENTICATION = "require_authentication"
+
+# Requests to devices: seconds to connect and to wait for data, attempts
+# and the delay before the first retry, doubled on every further retry
+HTTP_CONNECT_TIMEOUT = 3
+HTTP_READ_TIMEOUT = 5
+HTTP_ATTEMPTS = 3
+HTTP_RETRY_DELAY = 0.5
+
+# Key of the zeroconf discoveries not adopted yet in hass.data[DOMAIN]
+DISCOVERED = "discovered"
+# Devices queried and adopted at the same time by the bulk adoption flow
+BULK_ADOPT_CONCURRENCY = 16
+
+# Limits for frames sent by devices, larger frames close the connection
+MAX_FIELD_SIZE = 1024
+MAX_FRAME_SIZE = 64 * 1024
+# Bytes requested from the socket per read
+READ_SIZE = 16 * 1024
+# With decode workers, the buffers read from all connections in one loop
+# iteration go to a worker together, batches are cut at this many bytes
+POOL_BATCH_SIZE = 256 * 1024
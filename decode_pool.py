@@ -0,0 +1,99 @@
+"""ESP Simple Devices frame decoding in worker processes"""
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+import multiprocessing
+
+from homeassistant.core import logging
+
+from .const import POOL_BATCH_SIZE
+from .metrics import ESPSimpleMetrics
+from .protocol import decode_buffers, decode_frames
+
+
+class ESPSimpleDecodePool:
+    """Decodes the buffers of many connections per worker round trip
+
+    Buffers handed in while the loop runs one iteration are collected and
+    sent to a worker as one batch, cut at POOL_BATCH_SIZE bytes. Batches of
+    successive iterations run on the workers in parallel. Should the pool
+    break, buffers are decoded on the loop from then on.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, workers: int) -> None:
+        self.loop: asyncio.AbstractEventLoop = loop
+        self.workers: int = workers
+        # Forking the Home Assistant process is not safe, workers start
+        # fresh and only import the integration
+        self.executor: ProcessPoolExecutor = ProcessPoolExecutor(
+            workers, mp_context=multiprocessing.get_context("spawn")
+        )
+        self.buffers: list = list()
+        self.futures: list = list()
+        self.size: int = 0
+        self.flush_scheduled: bool = False
+        self.broken: bool = False
+
+    def decode(self, data: bytes) -> asyncio.Future:
+        """Queues a buffer, resolves to its decode_frames result"""
+        future = self.loop.create_future()
+        if self.broken:
+            future.set_result(decode_frames(data))
+            return future
+        self.buffers.append(data)
+        self.futures.append(future)
+        self.size += len(data)
+        if self.size >= POOL_BATCH_SIZE:
+            self.flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self.flush)
+        return future
+
+    def flush(self) -> None:
+        """Sends the queued buffers to a worker"""
+        self.flush_scheduled = False
+        if not self.buffers:
+            return
+        buffers, futures = self.buffers, self.futures
+        self.buffers, self.futures, self.size = list(), list(), 0
+        ESPSimpleMetrics.increment("pool_batches")
+        ESPSimpleMetrics.increment("pool_buffers", len(buffers))
+        try:
+            job = self.loop.run_in_executor(self.executor, decode_buffers, buffers)
+        except RuntimeError as err:
+            # Broken or shut down
+            self.decode_on_loop(buffers, futures, err)
+            return
+        job.add_done_callback(partial(self.resolve_job, buffers, futures))
+
+    def resolve_job(self, buffers: list, futures: list, job: asyncio.Future) -> None:
+        """Hands the results of a batch to the connections waiting for them"""
+        if job.cancelled():
+            # Shut down while the batch was waiting, not a failure
+            self.decode_on_loop(buffers, futures)
+        elif job.exception() is not None:
+            self.decode_on_loop(buffers, futures, job.exception())
+        else:
+            for future, result in zip(futures, job.result()):
+                if not future.done():
+                    future.set_result(result)
+
+    def decode_on_loop(
+        self, buffers: list, futures: list, err: BaseException | None = None
+    ) -> None:
+        """Decodes a batch on the loop after the pool failed with err"""
+        if err is not None:
+            ESPSimpleMetrics.increment("pool_failures")
+            if not self.broken:
+                self.broken = True
+                logging.warning(
+                    "Decode workers failed, decoding on the loop: " + repr(err)
+                )
+        for future, data in zip(futures, buffers):
+            if not future.done():
+                future.set_result(decode_frames(data))
+
+    def shutdown(self) -> None:
+        """Stops the workers, blocks until they exited"""
+        self.executor.shutdown(cancel_futures=True)
@@ -0,0 +1,47 @@
+"""Diagnostics support for ESP Simple Devices."""
+from __future__ import annotations
+
+from typing import Any
+
+from homeassistant.components.diagnostics import async_redact_data
+from homeassistant.config_entries import ConfigEntry
+from homeassistant.core import HomeAssistant
+
+from . import get_socket_server
+from .espsimple import ESPSimpleDeviceRegistry
+from .metrics import ESPSimpleMetrics
+
+TO_REDACT = {"encryption_key"}
+
+
+async def async_get_config_entry_diagnostics(
+    hass: HomeAssistant, entry: ConfigEntry
+) -> dict[str, Any]:
+    """Return diagnostics for a config entry."""
+    server = get_socket_server()
+    device = ESPSimpleDeviceRegistry.get_device(entry.data["device_id"])
+
+    device_data = None
+    if device is not None:
+        device_data = {
+            "sensor_count": len(device.sensors),
+            "suppressed_updates": device.suppressed_updates(),
+            "rate_limited_frames": device.rate_limit.limited,
+            "sensors": {
+                sensor_id: {
+                    "accepted_updates": sensor.update_filter.accepted,
+                    "suppressed_updates": sensor.update_filter.suppressed,
+                }
+                for sensor_id, sensor in device.sensors.items()
+            },
+        }
+
+    return {
+        "entry": {
+            "data": async_redact_data(entry.data, TO_REDACT),
+            "options": dict(entry.options),
+        },
+        "device": device_data,
+        "server": server.diagnostics() if server is not None else None,
+        "metrics": ESPSimpleMetrics.as_dict(),
+    }
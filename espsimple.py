@@ -1,5 +1,10 @@
 """ESP Simple Devices"""
 
+import hashlib
+import hmac
+import os
+import sys
+import threading
 from typing import Any
 from datetime import date, datetime
 from decimal import Decimal
@@ -9,39 +14,136 @@ from homeassistant.components.sensor import (
     SensorEntity,
     SensorStateClass,
 )
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, callback
 from homeassistant.helpers.entity_platform import EntityPlatform
 from homeassistant.helpers.typing import StateType
 from homeassistant.helpers.entity import DeviceInfo
+from .admission import ESPSimpleRateLimit
+from .const import (
+    CONF_REQUIRE_AUTHENTICATION,
+    CONF_SENSORS,
+    DATAGRAM_EPOCH_SIZE,
+    DEVICE_RATE_BURST,
+    DEVICE_RATE_LIMIT,
+)
+from .metrics import ESPSimpleMetrics
 from .persistent_storage import ESPSimpleStorage
+from .protocol import parse_state
+from .session import ESPSimpleSessionKeys
+from .update_filter import (
+    ESPSimpleUpdateFilter,
+    filter_settings,
+    reporting_settings,
+)
+
+
+# Size of the HMAC-SHA256 signatures of datagrams
+DIGEST_SIZE = hashlib.sha256().digest_size
 
 
 class ESPSimpleDeviceRegistry:
-    """ESPSimpleDeviceHandler"""
+    """ESPSimpleDeviceHandler
 
-    device_list: list = list()
+    Devices are indexed by device_id, sensors by their numeric handle.
+    Changes are made under a lock, lookups are plain dict and list reads.
+    """
+
+    devices: dict = dict()
+    # Sensors indexed by handle, None for handles not in use
+    sensor_handles: list = [None]
+    lock: threading.Lock = threading.Lock()
 
     @staticmethod
     def add_device(device: Any) -> None:
         """Adds devices"""
-        ESPSimpleDeviceRegistry.device_list.append(device)
+        with ESPSimpleDeviceRegistry.lock:
+            ESPSimpleDeviceRegistry.devices[device.device_id] = device
 
     @staticmethod
     def get_device(id_str: str) -> Any:
         """Gets devices"""
-        for d in ESPSimpleDeviceRegistry.device_list:
-            if d.device_id == id_str:
-                return d
+        return ESPSimpleDeviceRegistry.devices.get(id_str)
 
     @staticmethod
     def remove_device(id_str: str) -> None:
         """Removes devices"""
-        for d in ESPSimpleDeviceRegistry.device_list:
-            if d.device_id == id_str:
-                ESPSimpleDeviceRegistry.device_list.remove(d)
+        with ESPSimpleDeviceRegistry.lock:
+            ESPSimpleDeviceRegistry.devices.pop(id_str, None)
+
+    @staticmethod
+    def allocate_handle() -> int:
+        """Gets an unused sensor handle
+
+        The next handle is kept in storage, handles never get reused.
+        """
+        with ESPSimpleDeviceRegistry.lock:
+            handle = ESPSimpleStorage.next_handle
+            ESPSimpleStorage.next_handle = handle + 1
+            return handle
+
+    @staticmethod
+    def add_sensor_handles(sensors: list) -> None:
+        """Makes sensors reachable by their handles"""
+        with ESPSimpleDeviceRegistry.lock:
+            handles = ESPSimpleDeviceRegistry.sensor_handles
+            for sensor in sensors:
+                handle = sensor.info.handle
+                if handle >= len(handles):
+                    handles.extend([None] * (handle + 1 - len(handles)))
+                handles[handle] = sensor
+                if handle >= ESPSimpleStorage.next_handle:
+                    ESPSimpleStorage.next_handle = handle + 1
+
+    @staticmethod
+    def remove_sensor_handle(sensor: Any) -> None:
+        """Removes a sensor from the handle index"""
+        handle = sensor.info.handle
+        with ESPSimpleDeviceRegistry.lock:
+            handles = ESPSimpleDeviceRegistry.sensor_handles
+            if handle < len(handles) and handles[handle] is sensor:
+                handles[handle] = None
+
+    @staticmethod
+    def get_sensor_by_handle(handle: int) -> Any:
+        """Gets a sensor by handle"""
+        handles = ESPSimpleDeviceRegistry.sensor_handles
+        if handle < len(handles):
+            return handles[handle]
+        return None
+
+
+def enum_value(enum: Any, value: str) -> Any:
+    """Gets the enum member for a reported value, None if there is none"""
+    if value == "":
+        return None
+    try:
+        return enum(value)
+    except ValueError:
+        return None
 
 
 class ESPSimpleDevice:
+    __slots__ = (
+        "device_id",
+        "friendly_name",
+        "model",
+        "sw_version",
+        "entity_platform",
+        "sensors",
+        "lock",
+        "options",
+        "encryption_key",
+        "auth_hmac",
+        "session_keys",
+        "udp_epoch",
+        "udp_sequence",
+        "cached_device_info",
+        "manifest_fingerprint",
+        "manifest_ack",
+        "rate_limit",
+        "connections",
+    )
+
     def __init__(
         self,
         device_id: str,
@@ -55,31 +157,164 @@ class ESPSimpleDevice:
         self.model: str = model
         self.sw_version: str = sw_version
         self.entity_platform: EntityPlatform = entity_platform
-        self.sensors: list = list()
+        # Sensors indexed by the sensor id the device reports
+        self.sensors: dict = dict()
+        self.lock: threading.Lock = threading.Lock()
+        # Config entry options, holding the update filter settings
+        self.options: dict = dict()
+        # Key shared with the device on adoption
+        self.encryption_key: str | None = None
+        self.auth_hmac: Any = None
+        self.session_keys: ESPSimpleSessionKeys | None = None
+        # Epoch datagrams are signed over and the sequence number of the
+        # last datagram accepted in it
+        self.udp_epoch: bytes | None = None
+        self.udp_sequence: int = 0
+        # Shared by all sensors of the device
+        self.cached_device_info: DeviceInfo | None = None
+        # Fingerprint and ack of the last manifest, reset by any other change
+        # to the sensors
+        self.manifest_fingerprint: int | None = None
+        self.manifest_ack: bytes | None = None
+        self.rate_limit: ESPSimpleRateLimit = ESPSimpleRateLimit(
+            DEVICE_RATE_LIMIT, DEVICE_RATE_BURST
+        )
+        # Open keep-alive connections, the reporting settings are pushed to
+        self.connections: set = set()
+
+    @property
+    def device_info(self) -> DeviceInfo:
+        """Device info of the device's sensors, built once"""
+        if self.cached_device_info is None:
+            self.cached_device_info = DeviceInfo(
+                identifiers={
+                    # Serial numbers are unique identifiers within a specific domain
+                    ("espsimple", self.device_id)
+                },
+                name=self.friendly_name,
+                manufacturer="ESP Simple Devices",
+                model=self.model,
+                sw_version=self.sw_version,
+                via_device=("espsimple", self.device_id),
+            )
+        return self.cached_device_info
+
+    def set_encryption_key(self, encryption_key: str | None) -> None:
+        """Sets the key used to authenticate the device"""
+        self.encryption_key = encryption_key
+        self.auth_hmac = None
+        self.session_keys = None
+        if encryption_key:
+            key = encryption_key.encode("utf-8")
+            # Keyed once, every signature check works on a copy
+            self.auth_hmac = hmac.new(key, digestmod=hashlib.sha256)
+            self.session_keys = ESPSimpleSessionKeys(key)
+
+    @property
+    def require_authentication(self) -> bool:
+        """Whether frames of the device are only accepted when authenticated"""
+        return bool(self.options.get(CONF_REQUIRE_AUTHENTICATION, False))
+
+    def open_udp_epoch(self) -> bytes:
+        """Starts a new datagram epoch, ending the old one"""
+        self.udp_epoch = os.urandom(DATAGRAM_EPOCH_SIZE)
+        self.udp_sequence = 0
+        return self.udp_epoch
+
+    def verify_signature(self, data: Any, signature: Any) -> bool:
+        """Checks the HMAC-SHA256 signature of a datagram over the epoch"""
+        if self.auth_hmac is None or self.udp_epoch is None:
+            return False
+        mac = self.auth_hmac.copy()
+        mac.update(self.udp_epoch)
+        mac.update(data)
+        return hmac.compare_digest(mac.digest(), bytes(signature))
 
     def get_sensor(self, id: str) -> Any:
-        """Gets sensor by id of this device"""
-        for s in self.sensors:
-            if s.unique_id == id:
-                return s
+        """Gets sensor by the id reported by this device"""
+        return self.sensors.get(id)
+
+    def add_sensor(self, sensor: Any) -> None:
+        """Adds restored sensor to device"""
+        self.add_sensors([sensor])
+
+    def add_sensors(self, sensors: list) -> None:
+        """Adds restored sensors to device, taking each lock once"""
+        for sensor in sensors:
+            sensor.update_filter.configure(
+                filter_settings(self.options, sensor.info.unique_id)
+            )
+            if sensor.info.handle is None:
+                sensor.info.handle = ESPSimpleDeviceRegistry.allocate_handle()
+        with self.lock:
+            for sensor in sensors:
+                self.sensors[sensor.info.unique_id] = sensor
+        ESPSimpleDeviceRegistry.add_sensor_handles(sensors)
 
-    def add_sensor(self, sensor: Any, add_entity: bool = True) -> None:
-        """Adds discovered sensor to device"""
-        self.sensors.append(sensor)
-        if add_entity:
-            self.entity_platform.add_entities([sensor])
+    async def async_add_sensors(self, sensors: list) -> None:
+        """Adds discovered sensors to device and creates their entities at once"""
+        self.add_sensors(sensors)
+        await self.entity_platform.async_add_entities(sensors)
 
     def remove_sensor(self, sensor: Any) -> None:
         """Removes a sensor"""
+        with self.lock:
+            self.sensors.pop(sensor.info.unique_id, None)
+        self.manifest_fingerprint = None
+        ESPSimpleDeviceRegistry.remove_sensor_handle(sensor)
+        ESPSimpleStorage.forget_state(sensor.info.handle)
         self.entity_platform.async_remove_entity(sensor.unique_id)
 
+    def configure_filters(self, options: dict) -> None:
+        """Applies changed config entry options to all sensors"""
+        self.options = options
+        for sensor_id, sensor in self.sensors.items():
+            sensor.update_filter.configure(filter_settings(options, sensor_id))
+
+    def reporting_config(self) -> tuple:
+        """Report interval and deadband entries to push to the device
+
+        The device defaults come first under the empty sensor id, followed
+        by the sensors overriding them. Empty if nothing is set.
+        """
+        default = tuple(reporting_settings(self.options).values())
+        entries = [("",) + default]
+        for sensor_id in self.options.get(CONF_SENSORS, dict()):
+            settings = tuple(reporting_settings(self.options, sensor_id).values())
+            if settings != default:
+                entries.append((sensor_id,) + settings)
+        if len(entries) == 1 and not any(default):
+            return ()
+        return tuple(entries)
+
+    def suppressed_updates(self) -> int:
+        """Counts the updates dropped by the update filters"""
+        return sum(s.update_filter.suppressed for s in self.sensors.values())
+
     def remove_all_sensors(self) -> None:
         """Removes all sensors"""
-        for sensor in self.sensors:
+        for sensor in list(self.sensors.values()):
             self.remove_sensor(sensor)
 
 
 class ESPSimpleSensorInfo:
+    """Sensor metadata
+
+    Sensor ids, units and classes repeat across devices, they are interned
+    so every sensor shares one copy.
+    """
+
+    __slots__ = (
+        "name",
+        "unique_id",
+        "device",
+        "unit_of_measurement",
+        "device_class",
+        "state_class",
+        "handle",
+        "fingerprint",
+    )
+
     def __init__(
         self,
         name: str,
@@ -88,80 +323,90 @@ class ESPSimpleSensorInfo:
         unit_of_measurement: str,
         device_class: SensorDeviceClass,
         state_class: SensorStateClass,
+        handle: int | None = None,
     ) -> None:
         self.name: str = name
-        self.unique_id: str = unique_id
+        self.unique_id: str = sys.intern(unique_id)
         self.device: ESPSimpleDevice = device
-        self.unit_of_measurement: str = unit_of_measurement
-        self.device_class: SensorDeviceClass = device_class
-        self.state_class: SensorStateClass = state_class
+        self.unit_of_measurement: str = sys.intern(unit_of_measurement)
+        self.device_class: SensorDeviceClass = sys.intern(device_class)
+        self.state_class: SensorStateClass = sys.intern(state_class)
+        # Numeric id used by devices instead of device and sensor id
+        self.handle: int | None = handle
+        # Hash of the registration the metadata was last taken from
+        self.fingerprint: int | None = None
+
+    def update(
+        self,
+        name: str,
+        unit_of_measurement: str,
+        device_class: SensorDeviceClass,
+        state_class: SensorStateClass,
+    ) -> bool:
+        """Sets reported metadata, returns whether anything changed"""
+        if (
+            name == self.name
+            and unit_of_measurement == self.unit_of_measurement
+            and device_class == self.device_class
+            and state_class == self.state_class
+        ):
+            return False
+        self.name = name
+        self.unit_of_measurement = sys.intern(unit_of_measurement)
+        self.device_class = sys.intern(device_class)
+        self.state_class = sys.intern(state_class)
+        return True
 
 
 class ESPSimpleSensor(SensorEntity):
     """Representation of a Sensor."""
 
+    # States are pushed by the device
+    _attr_should_poll = False
+
     def __init__(self, hass: HomeAssistant, info: ESPSimpleSensorInfo) -> None:
         self.hass: HomeAssistant = hass
         self.info: ESPSimpleSensorInfo = info
-        self.state_value: str = ""
+        # Native state, string states are converted once when they arrive
+        self.state_value: Any = ""
+        self.write_scheduled: bool = False
+        self.update_filter: ESPSimpleUpdateFilter = ESPSimpleUpdateFilter()
+        self._attr_unique_id = info.device.device_id + "_" + info.unique_id
+        self._attr_device_info = info.device.device_info
+        self.apply_info()
 
-    @property
-    def native_value(self) -> StateType | date | datetime | Decimal:
-        try:
-            return float(self.state_value)
-        except ValueError:
-            return self.state_value
-
-    @property
-    def state_class(self) -> SensorStateClass | str | None:
-        if self.info.state_class == "":
-            return None
-        try:
-            return SensorStateClass(self.info.state_class)
-        except:
-            return None
+    def apply_info(self) -> None:
+        """Derives the entity attributes from info
 
-    @property
-    def device_class(self) -> SensorDeviceClass | None:
-        if self.info.device_class == "":
-            return None
-        try:
-            return SensorDeviceClass(self.info.device_class)
-        except:
-            return None
+        Home Assistant caches them until they are set again, call this
+        whenever info changed.
+        """
+        self._attr_name = self.info.name
+        self._attr_native_unit_of_measurement = self.info.unit_of_measurement.strip()
+        self._attr_device_class = enum_value(SensorDeviceClass, self.info.device_class)
+        self._attr_state_class = enum_value(SensorStateClass, self.info.state_class)
 
     @property
-    def native_unit_of_measurement(self) -> str | None:
-        return self.info.unit_of_measurement.strip()
-
-    @property
-    def unique_id(self) -> str | None:
-        return self.info.device.device_id + "_" + self.info.unique_id
+    def native_value(self) -> StateType | date | datetime | Decimal:
+        return self.state_value
 
-    @property
-    def name(self) -> str | None:
-        return self.info.name
+    def set_state(self, state, set_state: bool = True):
+        """Sets the state, writing it to Home Assistant on the next loop tick
 
-    @property
-    def device_info(self) -> DeviceInfo:
-        return DeviceInfo(
-            identifiers={
-                # Serial numbers are unique identifiers within a specific domain
-                ("espsimple", self.info.device.device_id)
-            },
-            name=self.info.device.friendly_name,
-            manufacturer="ESP Simple Devices",
-            model=self.info.device.model,
-            sw_version=self.info.device.sw_version,
-            via_device=("espsimple", self.info.device.device_id),
-        )
+        Safe to call from any thread. Only the latest state is kept, so a
+        burst of readings within one loop tick results in one state write.
+        """
+        self.state_value = parse_state(state)
+        if set_state and not self.write_scheduled:
+            self.write_scheduled = True
+            self.hass.loop.call_soon_threadsafe(self.async_write_pending_state)
 
-    def set_state(self, state, set_state: bool = True):
-        if set_state:
-            state_attrs = self.hass.states.get(self.entity_id).attributes
-            self.hass.states.set(
-                self.entity_id,
-                state,
-                attributes=state_attrs,
-            )
-        self.state_value = state
+    @callback
+    def async_write_pending_state(self) -> None:
+        """Writes the latest state to Home Assistant"""
+        self.write_scheduled = False
+        if self.entity_id is None:
+            # Not added to Home Assistant yet, the state is written on add
+            return
+        with ESPSimpleMetrics.measure("state_write"):
+            self.async_write_ha_state()
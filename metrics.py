@@ -0,0 +1,116 @@
+"""ESP Simple Devices runtime metrics"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import time
+
+# Upper bounds of the latency histogram buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+
+class ESPSimpleLatency:
+    """Latency histogram with fixed buckets"""
+
+    def __init__(self) -> None:
+        self.buckets: list = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count: int = 0
+        self.total: float = 0
+        self.max: float = 0
+
+    def record(self, seconds: float) -> None:
+        """Adds a measurement"""
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def as_dict(self) -> dict:
+        """Gets the histogram as a dict"""
+        labels = ["<=" + str(b) for b in LATENCY_BUCKETS] + [
+            ">" + str(LATENCY_BUCKETS[-1])
+        ]
+        return {
+            "count": self.count,
+            "mean": self.total / self.count if self.count else 0,
+            "max": self.max,
+            "buckets": dict(zip(labels, self.buckets)),
+        }
+
+
+class ESPSimpleMetrics:
+    """Counters and latencies of the hot path
+
+    Counters:
+    connections, connection_timeouts, connection_errors, connections_rejected,
+    connections_drain_timeouts,
+    frames_<type>, frames_malformed, frames_rejected,
+    updates_applied, updates_suppressed, updates_unknown_device,
+    updates_unknown_sensor, updates_unknown_handle,
+    registrations_unknown_device, storage_writes, datagrams,
+    datagrams_malformed, datagrams_unauthenticated, datagrams_replayed,
+    sessions, auth_failures, frames_unauthenticated, manifests_unchanged,
+    state_log_writes, state_log_compactions, pool_batches, pool_buffers,
+    pool_failures,
+    updates_merged, updates_overloaded, updates_rate_limited,
+    datagrams_dropped, configs_sent
+
+    Latencies:
+    frame_parse, frame_<type> (parsing and handling a frame), set_state,
+    state_write, storage_write, state_log_write, device_restore,
+    pool_decode (waiting for a worker to decode a buffer, batching included)
+
+    Startup, in seconds since storage started loading:
+    storage_load, completed (every config entry restored its device),
+    entries, devices, sensors
+    """
+
+    counters: dict = dict()
+    latencies: dict = dict()
+    startup: dict = dict()
+
+    @staticmethod
+    def increment(name: str, count: int = 1) -> None:
+        """Increments a counter"""
+        ESPSimpleMetrics.counters[name] = ESPSimpleMetrics.counters.get(name, 0) + count
+
+    @staticmethod
+    def record(name: str, seconds: float) -> None:
+        """Records a latency"""
+        latency = ESPSimpleMetrics.latencies.get(name)
+        if latency is None:
+            latency = ESPSimpleMetrics.latencies[name] = ESPSimpleLatency()
+        latency.record(seconds)
+
+    @staticmethod
+    @contextmanager
+    def measure(name: str):
+        """Records the latency of the wrapped block"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            ESPSimpleMetrics.record(name, time.perf_counter() - start)
+
+    @staticmethod
+    def reset() -> None:
+        """Clears all metrics"""
+        ESPSimpleMetrics.counters = dict()
+        ESPSimpleMetrics.latencies = dict()
+        ESPSimpleMetrics.startup = dict()
+
+    @staticmethod
+    def as_dict() -> dict:
+        """Gets all metrics as a dict"""
+        return {
+            "startup": {
+                name: value
+                for name, value in ESPSimpleMetrics.startup.items()
+                if name != "started"
+            },
+            "counters": dict(sorted(ESPSimpleMetrics.counters.items())),
+            "latencies": {
+                name: latency.as_dict()
+                for name, latency in sorted(ESPSimpleMetrics.latencies.items())
+            },
+        }
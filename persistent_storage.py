@@ -1,17 +1,53 @@
-"""ESP Simple Devices persistent storage"""
+"""ESP Simple Devices persistent storage
+
+Device and sensor metadata is kept in a JSON file that is only written
+when it changes. Last states go to the append-only state log.
+"""
+import asyncio
 import json
 import os
+import time
 from typing import Any
 
+from homeassistant.const import EVENT_HOMEASSISTANT_FINAL_WRITE
+from homeassistant.core import Event, HomeAssistant, callback
+from .const import STORAGE_SAVE_DELAY
+from .metrics import ESPSimpleMetrics
+from .state_log import ESPSimpleStateLog
+
 
 class ESPSimpleStorage:
     """ESPSimpleStorage"""
 
     config_file: str = "/config/.storage/espsimple.json"
 
+    # Write-behind state, only touched from the event loop
+    save_delay: float = STORAGE_SAVE_DELAY
+    # Devices changed since the last write by device id, None for removed
+    # ones. Stored devices not in here are written as they were read.
+    pending_devices: dict = dict()
+    # Last states not written to the state log yet, by sensor handle
+    pending_states: dict = dict()
+    save_handle: asyncio.TimerHandle | None = None
+    save_task: asyncio.Task | None = None
+    final_write_listener: Any = None
+
+    # Read of the storage file shared by all config entries
+    load_task: asyncio.Task | None = None
+
+    # In-memory copy of the storage file, the file is only read once
+    data: dict = dict()
+    # Whether pending devices changed since they were merged into data
+    cache_stale: bool = False
+    device_index: dict = dict()
+    # Next sensor handle to allocate, stored so removed handles stay unused
+    next_handle: int = 1
+    # Latest state of every sensor by handle
+    states: dict = dict()
+
     @staticmethod
     def init_storage(directory: str) -> None:
-        """Initializes storage"""
+        """Initializes storage and loads it into memory"""
         ESPSimpleStorage.config_file = directory + "/.storage/espsimple.json"
         if not os.path.isfile(ESPSimpleStorage.config_file):
             try:
@@ -23,10 +59,94 @@ class ESPSimpleStorage:
                     f.close()
             except OSError:
                 return None
+        ESPSimpleStorage.load_storage()
+        ESPSimpleStorage.load_states(directory + "/.storage/espsimple.states")
+
+    @staticmethod
+    def load_storage() -> None:
+        """Reads the storage file into memory"""
+        try:
+            with open(ESPSimpleStorage.config_file, mode="r", encoding="utf-8") as f:
+                storage_json = json.load(f)
+        except OSError:
+            storage_json = dict()
+        except json.decoder.JSONDecodeError:
+            ESPSimpleStorage.wipe_storage()
+            storage_json = dict()
+
+        ESPSimpleStorage.data = storage_json
+        ESPSimpleStorage.set_cache(storage_json.get("devices", list()))
+        # Storage written before the mark existed starts after its handles
+        ESPSimpleStorage.next_handle = max(
+            [storage_json.get("next_handle", 1)]
+            + [
+                (sensor.get("handle") or 0) + 1
+                for device in ESPSimpleStorage.data["devices"]
+                for sensor in device.get("sensors", list())
+            ]
+        )
+
+    @staticmethod
+    def load_states(log_file: str) -> None:
+        """Reads the state log into memory
+
+        Last states of storage written before the state log existed are
+        moved to the log, states of sensors no longer in storage are
+        dropped from it.
+        """
+        states = ESPSimpleStateLog.load(log_file)
+        handles = set()
+        migrated = False
+        for device in ESPSimpleStorage.data["devices"]:
+            for sensor in device.get("sensors", list()):
+                handle = sensor.get("handle")
+                handles.add(handle)
+                if handle is None or handle in states or "last_state" not in sensor:
+                    continue
+                states[handle] = sensor["last_state"]
+                migrated = True
+        removed = [handle for handle in states if handle not in handles]
+        for handle in removed:
+            del states[handle]
+        if migrated or removed:
+            ESPSimpleStateLog.compact(states)
+        ESPSimpleStorage.states = states
+
+    @staticmethod
+    def get_state(handle: int | None, default: Any = None) -> Any:
+        """Gets the last state of a sensor"""
+        return ESPSimpleStorage.states.get(handle, default)
+
+    @staticmethod
+    def set_cache(device_list: list) -> None:
+        """Replaces the in-memory devices"""
+        ESPSimpleStorage.data["devices"] = device_list
+        ESPSimpleStorage.device_index = {d["device_id"]: d for d in device_list}
+
+    @staticmethod
+    def update_cache(force: bool = False) -> None:
+        """Merges pending changes into the in-memory devices
+
+        Only pending devices are serialized again, and only after a change
+        was scheduled, unless forced. Other stored devices are kept.
+        """
+        if not ESPSimpleStorage.pending_devices:
+            return
+        if ESPSimpleStorage.cache_stale or force:
+            ESPSimpleStorage.cache_stale = False
+            index = ESPSimpleStorage.device_index
+            for device_id, device in ESPSimpleStorage.pending_devices.items():
+                if device is None:
+                    index.pop(device_id, None)
+                else:
+                    index[device_id] = ESPSimpleStorage.serialize_device(device)
+            ESPSimpleStorage.data["devices"] = list(index.values())
 
     @staticmethod
     def wipe_storage() -> None:
         """Wipes storage"""
+        ESPSimpleStorage.data = dict()
+        ESPSimpleStorage.device_index = dict()
         try:
             with open(ESPSimpleStorage.config_file, mode="w+", encoding="utf-8") as f:
                 f.write("{}")
@@ -38,83 +158,225 @@ class ESPSimpleStorage:
     @staticmethod
     def get_devices() -> Any:
         """Gets devices from storage"""
-        if not os.path.isfile(ESPSimpleStorage.config_file):
-            return None
-        try:
-            with open(ESPSimpleStorage.config_file, mode="r", encoding="utf-8") as f:
-                storage_json = json.load(f)
-                return storage_json["devices"]
-        except OSError:
-            return None
-        except json.decoder.JSONDecodeError:
-            ESPSimpleStorage.wipe_storage()
-            return None
+        ESPSimpleStorage.update_cache()
+        return ESPSimpleStorage.data.get("devices")
 
     @staticmethod
-    def set_devices(devices) -> Any:
-        """Sets devices to storage"""
-        if not os.path.isfile(ESPSimpleStorage.config_file):
-            return None
-        try:
-            with open(ESPSimpleStorage.config_file, mode="r", encoding="utf-8") as f:
-                storage_json = json.load(f)
-        except OSError:
-            return None
-        except json.decoder.JSONDecodeError:
-            ESPSimpleStorage.wipe_storage()
-            storage_json = json.loads("{}")
-            return None
-
-        device_list = list()
-        for device in devices:
-            sensor_list = list()
-            for sensor in device.sensors:
-                sensor_list.append(
-                    {
-                        "name": sensor.info.name,
-                        "unique_id": sensor.info.unique_id,
-                        "unit_of_measurement": sensor.info.unit_of_measurement,
-                        "device_class": sensor.info.device_class,
-                        "state_class": sensor.info.state_class,
-                        "last_state": sensor.native_value,
-                    }
-                )
-            device_list.append(
+    def serialize_device(device) -> dict:
+        """Builds the storage representation of a device"""
+        sensor_list = list()
+        for sensor in device.sensors.values():
+            sensor_list.append(
                 {
-                    "device_id": device.device_id,
-                    "friendly_name": device.friendly_name,
-                    "model": device.model,
-                    "sw_version": device.sw_version,
-                    "sensors": sensor_list,
+                    "name": sensor.info.name,
+                    "unique_id": sensor.info.unique_id,
+                    "unit_of_measurement": sensor.info.unit_of_measurement,
+                    "device_class": sensor.info.device_class,
+                    "state_class": sensor.info.state_class,
+                    "handle": sensor.info.handle,
                 }
             )
-        storage_json["devices"] = device_list
+        return {
+            "device_id": device.device_id,
+            "friendly_name": device.friendly_name,
+            "model": device.model,
+            "sw_version": device.sw_version,
+            "sensors": sensor_list,
+        }
 
+    @staticmethod
+    def write_storage(storage_json: dict) -> None:
+        """Writes storage, replacing the file atomically"""
+        temp_file = ESPSimpleStorage.config_file + ".tmp"
         try:
-            with open(ESPSimpleStorage.config_file, mode="w+", encoding="utf-8") as f:
+            with open(temp_file, mode="w", encoding="utf-8") as f:
                 json.dump(storage_json, f)
                 f.flush()
-                f.close()
+                os.fsync(f.fileno())
+            os.replace(temp_file, ESPSimpleStorage.config_file)
         except OSError:
             return None
 
     @staticmethod
-    def get_device(device_id) -> Any:
-        """Get device info from storage"""
-        if not os.path.isfile(ESPSimpleStorage.config_file):
-            return None
+    @callback
+    def async_schedule_save(
+        hass: HomeAssistant, devices, delay: float | None = None
+    ) -> None:
+        """Marks devices dirty, they are written once the delay has passed
+
+        Changes arriving while a save is scheduled are written together.
+        A shorter delay moves an already scheduled save forward.
+        """
+        if delay is None:
+            delay = ESPSimpleStorage.save_delay
+
+        ESPSimpleStorage.stage_devices(devices)
+        ESPSimpleStorage.async_schedule_write(hass, delay)
+
+    @staticmethod
+    @callback
+    def async_schedule_remove(
+        hass: HomeAssistant, device_id: str, delay: float | None = None
+    ) -> None:
+        """Drops a device from storage once the delay has passed"""
+        if delay is None:
+            delay = ESPSimpleStorage.save_delay
+
+        ESPSimpleStorage.pending_devices[device_id] = None
+        ESPSimpleStorage.cache_stale = True
+        ESPSimpleStorage.async_schedule_write(hass, delay)
+
+    @staticmethod
+    def stage_devices(devices) -> None:
+        """Marks devices dirty without scheduling a write
+
+        They are written with the next write.
+        """
+        for device in devices:
+            ESPSimpleStorage.pending_devices[device.device_id] = device
+        ESPSimpleStorage.cache_stale = True
+
+    @staticmethod
+    @callback
+    def async_schedule_state(hass: HomeAssistant, handle: int, state: Any) -> None:
+        """Records the last state of a sensor, it is logged with the next write"""
+        ESPSimpleStorage.stage_state(handle, state)
+        ESPSimpleStorage.async_schedule_write(hass, ESPSimpleStorage.save_delay)
+
+    @staticmethod
+    def stage_state(handle: int, state: Any) -> None:
+        """Records the last state of a sensor without scheduling a write"""
+        ESPSimpleStorage.states[handle] = state
+        ESPSimpleStorage.pending_states[handle] = state
+
+    @staticmethod
+    def forget_state(handle: int | None) -> None:
+        """Drops the last state of a removed sensor"""
+        ESPSimpleStorage.states.pop(handle, None)
+        ESPSimpleStorage.pending_states.pop(handle, None)
+
+    @staticmethod
+    @callback
+    def async_schedule_write(hass: HomeAssistant, delay: float) -> None:
+        """Schedules writing pending changes, a shorter delay moves it forward"""
+        if ESPSimpleStorage.final_write_listener is None:
+
+            async def async_final_write(event: Event) -> None:
+                """Flushes pending devices when Home Assistant stops"""
+                ESPSimpleStorage.final_write_listener = None
+                await ESPSimpleStorage.async_flush(hass)
+
+            ESPSimpleStorage.final_write_listener = hass.bus.async_listen_once(
+                EVENT_HOMEASSISTANT_FINAL_WRITE, async_final_write
+            )
+
+        handle = ESPSimpleStorage.save_handle
+        if handle is not None:
+            if handle.when() <= hass.loop.time() + delay:
+                return
+            handle.cancel()
+
+        ESPSimpleStorage.save_handle = hass.loop.call_later(
+            delay, ESPSimpleStorage.async_start_save, hass
+        )
+
+    @staticmethod
+    @callback
+    def async_start_save(hass: HomeAssistant) -> None:
+        """Starts writing pending devices"""
+        ESPSimpleStorage.save_handle = None
+        if ESPSimpleStorage.save_task is not None:
+            # The running write picks up the pending devices when it is done
+            return
+
+        ESPSimpleStorage.save_task = hass.async_create_task(
+            ESPSimpleStorage.async_save(hass)
+        )
+
+    @staticmethod
+    def has_pending() -> bool:
+        """Whether there are changes to write"""
+        return (
+            len(ESPSimpleStorage.pending_devices) > 0
+            or len(ESPSimpleStorage.pending_states) > 0
+        )
+
+    @staticmethod
+    async def async_save(hass: HomeAssistant) -> None:
+        """Writes pending devices and states off the event loop"""
         try:
-            with open(ESPSimpleStorage.config_file, mode="r", encoding="utf-8") as f:
-                storage_json = json.load(f)
-        except OSError:
-            return None
-        except json.decoder.JSONDecodeError:
-            ESPSimpleStorage.wipe_storage()
-            storage_json = json.loads("{}")
-            return None
+            while ESPSimpleStorage.has_pending():
+                if ESPSimpleStorage.pending_devices:
+                    with ESPSimpleMetrics.measure("storage_write"):
+                        ESPSimpleStorage.update_cache(True)
+                        ESPSimpleStorage.data["next_handle"] = (
+                            ESPSimpleStorage.next_handle
+                        )
+                        ESPSimpleStorage.pending_devices = dict()
+                        await hass.async_add_executor_job(
+                            ESPSimpleStorage.write_storage,
+                            dict(ESPSimpleStorage.data),
+                        )
+                    ESPSimpleMetrics.increment("storage_writes")
+
+                if ESPSimpleStorage.pending_states:
+                    records = ESPSimpleStorage.pending_states
+                    ESPSimpleStorage.pending_states = dict()
+                    states = None
+                    if ESPSimpleStateLog.needs_compaction():
+                        states = dict(ESPSimpleStorage.states)
+                        ESPSimpleMetrics.increment("state_log_compactions")
+                    with ESPSimpleMetrics.measure("state_log_write"):
+                        await hass.async_add_executor_job(
+                            ESPSimpleStateLog.write, records, states
+                        )
+                    ESPSimpleMetrics.increment("state_log_writes")
+        finally:
+            ESPSimpleStorage.save_task = None
+
+    @staticmethod
+    async def async_flush(hass: HomeAssistant) -> None:
+        """Writes pending devices now"""
+        if ESPSimpleStorage.save_handle is not None:
+            ESPSimpleStorage.save_handle.cancel()
+            ESPSimpleStorage.save_handle = None
+
+        if ESPSimpleStorage.save_task is None and ESPSimpleStorage.has_pending():
+            ESPSimpleStorage.save_task = hass.async_create_task(
+                ESPSimpleStorage.async_save(hass)
+            )
 
-        devices = storage_json["devices"]
+        if ESPSimpleStorage.save_task is not None:
+            await ESPSimpleStorage.save_task
 
-        for d in devices:
-            if d["device_id"] == device_id:
-                return d
+    @staticmethod
+    async def async_load(hass: HomeAssistant) -> None:
+        """Loads storage, every caller waits for the same read"""
+        if ESPSimpleStorage.load_task is None:
+            ESPSimpleMetrics.startup["started"] = time.perf_counter()
+            ESPSimpleStorage.load_task = hass.async_create_task(
+                ESPSimpleStorage.async_read(hass)
+            )
+        # A cancelled caller must not cancel the read the others wait for
+        await asyncio.shield(ESPSimpleStorage.load_task)
+
+    @staticmethod
+    async def async_read(hass: HomeAssistant) -> None:
+        """Reads and indexes the storage file off the event loop"""
+        start = time.perf_counter()
+        await hass.async_add_executor_job(
+            ESPSimpleStorage.init_storage, hass.config.config_dir
+        )
+        ESPSimpleMetrics.startup["storage_load"] = time.perf_counter() - start
+
+    @staticmethod
+    async def async_unload(hass: HomeAssistant) -> None:
+        """Writes pending devices, storage is read again on the next load"""
+        await ESPSimpleStorage.async_flush(hass)
+        ESPSimpleStorage.load_task = None
+
+    @staticmethod
+    def get_device(device_id) -> Any:
+        """Get device info from storage"""
+        ESPSimpleStorage.update_cache()
+        return ESPSimpleStorage.device_index.get(device_id)
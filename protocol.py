@@ -0,0 +1,335 @@
+"""ESP Simple Devices wire protocol
+
+Every frame starts with a type byte. Strings are sent as a 4 byte little
+endian length followed by UTF-8 data, counts as 4 byte little endian
+integers. Typed states are a tag byte followed by the value, strings use
+the string encoding. Nonces, proofs and sealed records are raw bytes.
+"""
+import struct
+from typing import Any, NamedTuple
+
+from .const import (
+    FRAME_AUTH_HELLO,
+    FRAME_AUTH_PROOF,
+    FRAME_BATCH_UPDATE,
+    FRAME_CONFIG,
+    FRAME_CONFIG_REQUEST,
+    FRAME_DATAGRAM_EPOCH,
+    FRAME_HANDLE_BATCH_UPDATE,
+    FRAME_HANDLE_REGISTRATION,
+    FRAME_HANDLE_UPDATE,
+    FRAME_KEEPALIVE,
+    FRAME_MANIFEST,
+    FRAME_REGISTRATION,
+    FRAME_SEALED,
+    FRAME_TYPED_BATCH_UPDATE,
+    FRAME_TYPED_UPDATE,
+    FRAME_UPDATE,
+    MAX_FIELD_SIZE,
+    MAX_FRAME_SIZE,
+    SESSION_NONCE_SIZE,
+    VALUE_BOOL,
+    VALUE_FLOAT32,
+    VALUE_FLOAT64,
+    VALUE_INT32,
+    VALUE_INT64,
+    VALUE_STRING,
+)
+
+# Size of the HMAC-SHA256 proof of FRAME_AUTH_PROOF
+PROOF_SIZE = 32
+
+# Report interval in milliseconds and deadband of a FRAME_CONFIG entry
+CONFIG_FORMAT = struct.Struct("<Id")
+
+# Struct formats of the fixed size typed states
+VALUE_FORMATS = {
+    VALUE_FLOAT32: struct.Struct("<f"),
+    VALUE_FLOAT64: struct.Struct("<d"),
+    VALUE_INT32: struct.Struct("<i"),
+    VALUE_INT64: struct.Struct("<q"),
+    VALUE_BOOL: struct.Struct("<?"),
+}
+
+
+def parse_state(value: Any) -> Any:
+    """Converts a reported string state to a number if it is numeric"""
+    if not isinstance(value, str):
+        return value
+    try:
+        return float(value)
+    except ValueError:
+        return value
+
+
+def shortest_float32(value: float) -> float:
+    """Rounds a float32 widened to a double to the digits it really has
+
+    21.3 is sent as 21.299999237060547, the shortest decimal packing to
+    the same float32 is kept instead.
+    """
+    packed = VALUE_FORMATS[VALUE_FLOAT32].pack(value)
+    for digits in range(6, 9):
+        rounded = float(f"{value:.{digits}g}")
+        if VALUE_FORMATS[VALUE_FLOAT32].pack(rounded) == packed:
+            return rounded
+    return float(f"{value:.9g}")
+
+
+def encode_value(value: Any) -> bytes:
+    """Encodes a state as a typed value"""
+    if isinstance(value, bool):
+        return bytes([VALUE_BOOL, value])
+    if isinstance(value, int) and -(2**63) <= value < 2**63:
+        return bytes([VALUE_INT64]) + VALUE_FORMATS[VALUE_INT64].pack(value)
+    if isinstance(value, float):
+        return bytes([VALUE_FLOAT64]) + VALUE_FORMATS[VALUE_FLOAT64].pack(value)
+    data = ("" if value is None else str(value)).encode("utf-8")
+    return bytes([VALUE_STRING]) + len(data).to_bytes(4, "little") + data
+
+
+def encode_config(entries: tuple) -> bytes:
+    """Encodes (sensor id, report interval, deadband) entries as FRAME_CONFIG"""
+    frame = bytearray([FRAME_CONFIG])
+    frame += len(entries).to_bytes(4, "little")
+    for sensor_id, interval, deadband in entries:
+        data = sensor_id.encode("utf-8")
+        frame += len(data).to_bytes(4, "little") + data
+        frame += CONFIG_FORMAT.pack(min(round(interval * 1000), 0xFFFFFFFF), deadband)
+    return bytes(frame)
+
+
+class FrameError(Exception):
+    """Raised for data that is not a valid frame"""
+
+
+class IncompleteFrame(Exception):
+    """Raised while parsing when the frame has not been received completely"""
+
+
+class Frame(NamedTuple):
+    """Decoded frame
+
+    fields holds the frame's fields in wire order, for batch updates the
+    device id followed by a tuple of (sensor id, state) pairs. States of
+    typed updates are decoded to numbers, bools or strings. Handle updates
+    hold the handle and the state, handle batch updates a tuple of (handle,
+    state) pairs. Sealed frames hold the encrypted record. Manifests hold
+    the device id and a tuple of (sensor id, name, unit, state class,
+    device class) tuples.
+    """
+
+    type: int
+    fields: tuple
+
+
+class ESPSimpleFrameDecoder:
+    """Incremental decoder for frames sent by devices
+
+    Received data is collected in one reusable buffer. Once a frame is
+    complete all of its fields are parsed in one pass over a memoryview of
+    the buffer, without copying the data.
+    """
+
+    def __init__(
+        self, max_field_size: int = MAX_FIELD_SIZE, max_frame_size: int = MAX_FRAME_SIZE
+    ) -> None:
+        self.max_field_size: int = max_field_size
+        self.max_frame_size: int = max_frame_size
+        self.buffer: bytearray = bytearray()
+        # Start of the first frame that has not been decoded yet
+        self.offset: int = 0
+
+    def feed(self, data: bytes) -> None:
+        """Adds received data"""
+        if self.offset and self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset > self.max_frame_size:
+            del self.buffer[: self.offset]
+            self.offset = 0
+        self.buffer += data
+
+    def pending(self) -> int:
+        """Number of received bytes not decoded yet"""
+        return len(self.buffer) - self.offset
+
+    def pending_data(self) -> bytes:
+        """Received bytes not decoded yet"""
+        return bytes(self.buffer[self.offset :])
+
+    def consume(self, size: int) -> None:
+        """Marks size pending bytes as decoded elsewhere"""
+        self.offset = min(self.offset + size, len(self.buffer))
+
+    def next_frame(self) -> Frame | None:
+        """Decodes the next frame, None if it has not been received completely"""
+        if self.offset == len(self.buffer):
+            return None
+
+        with memoryview(self.buffer) as view:
+            try:
+                frame, end = self.parse(view, self.offset)
+            except IncompleteFrame:
+                if self.pending() > self.max_frame_size:
+                    raise FrameError("Frame exceeds maximum size") from None
+                return None
+            except UnicodeDecodeError as err:
+                raise FrameError("Invalid string: " + str(err)) from None
+
+        if end - self.offset > self.max_frame_size:
+            raise FrameError("Frame exceeds maximum size")
+        self.offset = end
+        return frame
+
+    def read_uint(self, view: memoryview, pos: int) -> tuple[int, int]:
+        """Reads a 4 byte unsigned integer, returns it and the next position"""
+        end = pos + 4
+        if end > len(view):
+            raise IncompleteFrame
+        return int.from_bytes(view[pos:end], "little"), end
+
+    def read_string(self, view: memoryview, pos: int) -> tuple[str, int]:
+        """Reads a length prefixed string, returns it and the next position"""
+        length, pos = self.read_uint(view, pos)
+        if length > self.max_field_size:
+            raise FrameError("Field exceeds maximum size")
+        end = pos + length
+        if end > len(view):
+            raise IncompleteFrame
+        return str(view[pos:end], "utf-8"), end
+
+    def read_bytes(self, view: memoryview, pos: int, size: int) -> tuple[bytes, int]:
+        """Reads size raw bytes"""
+        end = pos + size
+        if end > len(view):
+            raise IncompleteFrame
+        return bytes(view[pos:end]), end
+
+    def read_value(self, view: memoryview, pos: int) -> tuple[Any, int]:
+        """Reads a typed state"""
+        if pos >= len(view):
+            raise IncompleteFrame
+        tag = view[pos]
+        pos += 1
+        if tag == VALUE_STRING:
+            return self.read_string(view, pos)
+
+        value_format = VALUE_FORMATS.get(tag)
+        if value_format is None:
+            raise FrameError("Unknown value type " + str(tag))
+        end = pos + value_format.size
+        if end > len(view):
+            raise IncompleteFrame
+        value = value_format.unpack_from(view, pos)[0]
+        if tag == VALUE_FLOAT32:
+            value = shortest_float32(value)
+        return value, end
+
+    def read_strings(self, view: memoryview, pos: int, count: int) -> tuple[Any, int]:
+        """Reads consecutive strings"""
+        fields = list()
+        for _ in range(count):
+            field, pos = self.read_string(view, pos)
+            fields.append(field)
+        return fields, pos
+
+    def parse(self, view: memoryview, pos: int) -> tuple[Frame, int]:
+        """Parses the frame starting at pos, returns it and its end"""
+        type = view[pos]
+        pos += 1
+
+        if type in (FRAME_REGISTRATION, FRAME_HANDLE_REGISTRATION):
+            fields, pos = self.read_strings(view, pos, 6)
+        elif type == FRAME_UPDATE:
+            fields, pos = self.read_strings(view, pos, 3)
+        elif type == FRAME_KEEPALIVE:
+            fields = ()
+        elif type == FRAME_TYPED_UPDATE:
+            fields, pos = self.read_strings(view, pos, 2)
+            value, pos = self.read_value(view, pos)
+            fields.append(value)
+        elif type in (FRAME_BATCH_UPDATE, FRAME_TYPED_BATCH_UPDATE):
+            device_id, pos = self.read_string(view, pos)
+            count, pos = self.read_uint(view, pos)
+            # Every pair takes at least 6 bytes
+            if count * 6 > self.max_frame_size:
+                raise FrameError("Batch exceeds maximum size")
+            if type == FRAME_TYPED_BATCH_UPDATE:
+                read_state = self.read_value
+            else:
+                read_state = self.read_string
+            updates = list()
+            for _ in range(count):
+                sensor_id, pos = self.read_string(view, pos)
+                value, pos = read_state(view, pos)
+                updates.append((sensor_id, value))
+            fields = (device_id, tuple(updates))
+        elif type == FRAME_HANDLE_UPDATE:
+            handle, pos = self.read_uint(view, pos)
+            value, pos = self.read_value(view, pos)
+            fields = (handle, value)
+        elif type == FRAME_HANDLE_BATCH_UPDATE:
+            count, pos = self.read_uint(view, pos)
+            # Every pair takes at least 6 bytes
+            if count * 6 > self.max_frame_size:
+                raise FrameError("Batch exceeds maximum size")
+            updates = list()
+            for _ in range(count):
+                handle, pos = self.read_uint(view, pos)
+                value, pos = self.read_value(view, pos)
+                updates.append((handle, value))
+            fields = (tuple(updates),)
+        elif type == FRAME_MANIFEST:
+            device_id, pos = self.read_string(view, pos)
+            count, pos = self.read_uint(view, pos)
+            # Every sensor takes at least 20 bytes
+            if count * 20 > self.max_frame_size:
+                raise FrameError("Manifest exceeds maximum size")
+            sensors = list()
+            for _ in range(count):
+                sensor, pos = self.read_strings(view, pos, 5)
+                sensors.append(tuple(sensor))
+            fields = (device_id, tuple(sensors))
+        elif type in (FRAME_AUTH_HELLO, FRAME_DATAGRAM_EPOCH, FRAME_CONFIG_REQUEST):
+            fields, pos = self.read_strings(view, pos, 1)
+        elif type == FRAME_AUTH_PROOF:
+            nonce, pos = self.read_bytes(view, pos, SESSION_NONCE_SIZE)
+            proof, pos = self.read_bytes(view, pos, PROOF_SIZE)
+            fields = (nonce, proof)
+        elif type == FRAME_SEALED:
+            length, pos = self.read_uint(view, pos)
+            if length > self.max_frame_size:
+                raise FrameError("Record exceeds maximum size")
+            record, pos = self.read_bytes(view, pos, length)
+            fields = (record,)
+        else:
+            raise FrameError("Unknown frame type " + str(type))
+
+        return Frame(type, tuple(fields)), pos
+
+
+def decode_frames(
+    data: bytes,
+    max_field_size: int = MAX_FIELD_SIZE,
+    max_frame_size: int = MAX_FRAME_SIZE,
+) -> tuple[list, int, str | None]:
+    """Decodes all complete frames in data
+
+    Returns the frames, the number of bytes they took and the error that
+    stopped decoding, if any.
+    """
+    decoder = ESPSimpleFrameDecoder(max_field_size, max_frame_size)
+    decoder.feed(data)
+    frames = list()
+    try:
+        while (frame := decoder.next_frame()) is not None:
+            frames.append(frame)
+    except FrameError as err:
+        return frames, decoder.offset, str(err)
+    return frames, decoder.offset, None
+
+
+def decode_buffers(buffers: list) -> list:
+    """Decodes the buffers of many connections, runs in decode workers"""
+    return [decode_frames(data) for data in buffers]
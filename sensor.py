@@ -1,14 +1,17 @@
 """Platform for sensor integration."""
 from __future__ import annotations
+import time
 from homeassistant.config_entries import ConfigEntry
-from homeassistant.core import HomeAssistant
+from homeassistant.core import HomeAssistant, logging
 from homeassistant.helpers.entity_platform import AddEntitiesCallback
+from .const import DOMAIN
 from .espsimple import (
     ESPSimpleSensor,
     ESPSimpleDevice,
     ESPSimpleDeviceRegistry,
     ESPSimpleSensorInfo,
 )
+from .metrics import ESPSimpleMetrics
 from .persistent_storage import ESPSimpleStorage
 from homeassistant.helpers import entity_platform as ep
 
@@ -17,11 +20,50 @@ def add_sensor(sensor: ESPSimpleSensor, async_add_entities: AddEntitiesCallback)
     async_add_entities([sensor])
 
 
+def report_startup(hass: HomeAssistant) -> bool:
+    """Logs how long startup took once every entry has restored its device
+
+    Returns whether every entry has restored its device.
+    """
+    startup = ESPSimpleMetrics.startup
+    if "started" not in startup or "completed" in startup:
+        return True
+
+    if "entries" not in startup:
+        startup["entries"] = sum(
+            1
+            for e in hass.config_entries.async_entries(DOMAIN)
+            if e.disabled_by is None
+        )
+    if ESPSimpleMetrics.counters.get("devices_restored", 0) < startup["entries"]:
+        return False
+
+    startup["completed"] = time.perf_counter() - startup["started"]
+    startup["devices"] = ESPSimpleMetrics.counters.get("devices_restored", 0)
+    startup["sensors"] = ESPSimpleMetrics.counters.get("sensors_restored", 0)
+    logging.info(
+        "Restored "
+        + str(startup["devices"])
+        + " devices with "
+        + str(startup["sensors"])
+        + " sensors in "
+        + str(round(startup["completed"] * 1000, 1))
+        + " ms, storage loaded in "
+        + str(round(startup.get("storage_load", 0) * 1000, 1))
+        + " ms"
+    )
+    return True
+
+
 async def async_setup_entry(
     hass: HomeAssistant, entry: ConfigEntry, async_add_entities: AddEntitiesCallback
 ) -> None:
     """Set up esphome device based on a config entry."""
 
+    # Shared by all entries, the file is read once
+    await ESPSimpleStorage.async_load(hass)
+    start = time.perf_counter()
+
     entity_platform = ep.async_get_current_platform()
 
     device = ESPSimpleDevice(
@@ -31,27 +73,53 @@ async def async_setup_entry(
         entry.data["sw_version"],
         entity_platform,
     )
+    device.options = dict(entry.options)
+    device.set_encryption_key(entry.data.get("encryption_key"))
 
     ESPSimpleDeviceRegistry.add_device(device)
 
     device_storage = ESPSimpleStorage.get_device(device.device_id)
 
     sensor_list = list()
+    # Sensors stored before handles existed, their state is logged once they
+    # have one
+    unlogged = list()
 
-    for sensor_storage in device_storage["sensors"]:
-        sensor = ESPSimpleSensor(
-            hass,
-            ESPSimpleSensorInfo(
-                sensor_storage["name"],
-                sensor_storage["unique_id"],
-                device,
-                sensor_storage["unit_of_measurement"],
-                sensor_storage["device_class"],
-                sensor_storage["state_class"],
-            ),
-        )
-        sensor.set_state(sensor_storage["last_state"], False)
-        device.add_sensor(sensor, False)
-        sensor_list.append(sensor)
+    if device_storage is not None:
+        for sensor_storage in device_storage["sensors"]:
+            sensor = ESPSimpleSensor(
+                hass,
+                ESPSimpleSensorInfo(
+                    sensor_storage["name"],
+                    sensor_storage["unique_id"],
+                    device,
+                    sensor_storage["unit_of_measurement"],
+                    sensor_storage["device_class"],
+                    sensor_storage["state_class"],
+                    sensor_storage.get("handle"),
+                ),
+            )
+            sensor.set_state(
+                ESPSimpleStorage.get_state(
+                    sensor.info.handle, sensor_storage.get("last_state", "")
+                ),
+                False,
+            )
+            if sensor.info.handle is None:
+                unlogged.append(sensor)
+            sensor_list.append(sensor)
+        device.add_sensors(sensor_list)
+
+    for sensor in unlogged:
+        ESPSimpleStorage.stage_state(sensor.info.handle, sensor.state_value)
+    if unlogged:
+        ESPSimpleStorage.stage_devices((device,))
 
     async_add_entities(sensor_list)
+
+    ESPSimpleMetrics.record("device_restore", time.perf_counter() - start)
+    ESPSimpleMetrics.increment("devices_restored")
+    ESPSimpleMetrics.increment("sensors_restored", len(sensor_list))
+    if report_startup(hass) and ESPSimpleStorage.has_pending():
+        # Migrated sensors are written once every entry has restored
+        ESPSimpleStorage.async_schedule_write(hass, ESPSimpleStorage.save_delay)
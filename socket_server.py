@@ -1,15 +1,60 @@
-import socket
-import threading
+import asyncio
+import os
+import time
+from typing import Any
 from homeassistant.config_entries import ConfigEntry
 from homeassistant.core import logging
 from homeassistant.core import HomeAssistant
+from .admission import retry_after_seconds
+from .decode_pool import ESPSimpleDecodePool
+from .const import (
+    ACCEPT_BACKLOG,
+    ACK_AUTH_FAILED,
+    ACK_OK,
+    ACK_RETRY_AFTER,
+    ACK_UNKNOWN_HANDLE,
+    DRAIN_TIMEOUT,
+    FRAME_AUTH_HELLO,
+    FRAME_AUTH_PROOF,
+    FRAME_BATCH_UPDATE,
+    FRAME_CONFIG_REQUEST,
+    FRAME_DATAGRAM_EPOCH,
+    FRAME_HANDLE_BATCH_UPDATE,
+    FRAME_HANDLE_REGISTRATION,
+    FRAME_HANDLE_UPDATE,
+    FRAME_KEEPALIVE,
+    FRAME_MANIFEST,
+    FRAME_REGISTRATION,
+    FRAME_SEALED,
+    FRAME_TYPED_BATCH_UPDATE,
+    FRAME_TYPED_UPDATE,
+    FRAME_UPDATE,
+    IDLE_TIMEOUT,
+    INGEST_QUEUE_SIZE,
+    MAX_CONNECTIONS,
+    MAX_FIELD_SIZE,
+    MAX_FRAME_SIZE,
+    OVERLOAD_RETRY_AFTER,
+    READ_SIZE,
+    SESSION_NONCE_SIZE,
+)
 from .espsimple import (
+    DIGEST_SIZE,
     ESPSimpleSensor,
     ESPSimpleSensorInfo,
     ESPSimpleDevice,
     ESPSimpleDeviceRegistry,
 )
+from .metrics import ESPSimpleMetrics
 from .persistent_storage import ESPSimpleStorage
+from .protocol import (
+    ESPSimpleFrameDecoder,
+    Frame,
+    FrameError,
+    encode_config,
+    parse_state,
+)
+from .session import ESPSimpleSession
 
 from homeassistant.components.sensor import (
     SensorDeviceClass,
@@ -18,160 +63,945 @@ from homeassistant.components.sensor import (
 )
 
 
+FRAME_NAMES = {
+    FRAME_REGISTRATION: "registration",
+    FRAME_UPDATE: "update",
+    FRAME_KEEPALIVE: "keepalive",
+    FRAME_BATCH_UPDATE: "batch_update",
+    FRAME_TYPED_UPDATE: "typed_update",
+    FRAME_TYPED_BATCH_UPDATE: "typed_batch_update",
+    FRAME_HANDLE_REGISTRATION: "handle_registration",
+    FRAME_HANDLE_UPDATE: "handle_update",
+    FRAME_HANDLE_BATCH_UPDATE: "handle_batch_update",
+    FRAME_AUTH_HELLO: "auth_hello",
+    FRAME_AUTH_PROOF: "auth_proof",
+    FRAME_SEALED: "sealed",
+    FRAME_MANIFEST: "manifest",
+    FRAME_DATAGRAM_EPOCH: "datagram_epoch",
+    FRAME_CONFIG_REQUEST: "config_request",
+}
+
+
+DEVICE_UPDATE_FRAMES = (
+    FRAME_UPDATE,
+    FRAME_BATCH_UPDATE,
+    FRAME_TYPED_UPDATE,
+    FRAME_TYPED_BATCH_UPDATE,
+)
+
+
+# Frames naming the device they are sent for in their first field
+DEVICE_ID_FRAMES = DEVICE_UPDATE_FRAMES + (
+    FRAME_REGISTRATION,
+    FRAME_HANDLE_REGISTRATION,
+    FRAME_MANIFEST,
+    FRAME_DATAGRAM_EPOCH,
+    FRAME_CONFIG_REQUEST,
+)
+
+# Frames handled by the session layer, not allowed inside sealed records
+SESSION_FRAMES = (FRAME_AUTH_HELLO, FRAME_AUTH_PROOF, FRAME_SEALED)
+
+
+def device_updates(frame: Frame) -> tuple | None:
+    """Gets device id and (sensor id, state) pairs of an update frame
+
+    Returns None if the frame is not an update frame or is malformed.
+    """
+    if frame.type in (FRAME_UPDATE, FRAME_TYPED_UPDATE):
+        device_id, sensor_id, state = frame.fields
+        updates = ((sensor_id, state),)
+    elif frame.type in (FRAME_BATCH_UPDATE, FRAME_TYPED_BATCH_UPDATE):
+        device_id, updates = frame.fields
+    else:
+        return None
+
+    if not device_id:
+        return None
+    for sensor_id, state in updates:
+        if not sensor_id or state == "":
+            return None
+    return device_id, updates
+
+
+def handle_updates(frame: Frame) -> tuple:
+    """Gets the (handle, state) pairs of a handle update frame"""
+    if frame.type == FRAME_HANDLE_UPDATE:
+        return (frame.fields,)
+    return frame.fields[0]
+
+
+class ESPSimpleSealedWriter:
+    """Seals everything written to a connection with the session cipher"""
+
+    def __init__(self, writer: asyncio.StreamWriter, session: ESPSimpleSession):
+        self.writer: asyncio.StreamWriter = writer
+        self.session: ESPSimpleSession = session
+
+    def write(self, data: bytes) -> None:
+        self.writer.write(self.session.seal(data))
+
+    async def drain(self) -> None:
+        await self.writer.drain()
+
+
+class ESPSimpleConnection:
+    """State of a device connection
+
+    device is the device that sent FRAME_AUTH_HELLO, it is authenticated
+    once session is set. From then on writer seals everything written.
+
+    attached is the device a keep-alive connection reports for, config the
+    FRAME_CONFIG last sent to it. Only connections that sent
+    FRAME_CONFIG_REQUEST get FRAME_CONFIG.
+    """
+
+    def __init__(self, writer: asyncio.StreamWriter) -> None:
+        self.writer: Any = writer
+        self.keep_alive: bool = False
+        self.device: ESPSimpleDevice | None = None
+        self.server_nonce: bytes | None = None
+        self.session: ESPSimpleSession | None = None
+        # Decodes the frames of opened records
+        self.records: ESPSimpleFrameDecoder | None = None
+        self.attached: ESPSimpleDevice | None = None
+        self.config: bytes | None = None
+        self.config_requested: bool = False
+
+
+class ESPSimpleDatagramProtocol(asyncio.DatagramProtocol):
+    """Receives update datagrams for ESPSimpleSocketServer"""
+
+    def __init__(self, server: "ESPSimpleSocketServer") -> None:
+        self.server: ESPSimpleSocketServer = server
+
+    def datagram_received(self, data: bytes, addr) -> None:
+        self.server.handle_datagram(data)
+
+
 class ESPSimpleSocketServer:
-    """TCP Socket Server for ESPSimpleDevices"""
+    """TCP Socket Server for ESPSimpleDevices
+
+    Legacy devices send one frame per connection. Devices that open the
+    connection with a keep-alive frame may send any number of frames on it,
+    without waiting for the ack of the previous one.
+
+    With udp_port set, updates may also be sent as signed UDP datagrams to
+    it, these are not acked. Registrations are only accepted over TCP.
+
+    Keep-alive connections can be encrypted with a session, see session.py.
+    Devices set to require authentication are only accepted over sessions
+    and as signed datagrams.
+
+    With decode_workers, frames are decoded by a pool of worker processes,
+    batching the buffers of all connections. The decoded frames are
+    handled on the event loop in order.
+
+    Reported states wait in the ingest queue until the next loop tick, a
+    newer state of a waiting sensor replaces the older one. Connections
+    over max_connections, update frames while the queue is full and update
+    frames over the rate limit of their device are answered with
+    ACK_RETRY_AFTER and dropped.
+
+    Keep-alive connections that sent FRAME_CONFIG_REQUEST get the reporting
+    settings of their device as FRAME_CONFIG, see push_config.
+    """
 
     def __init__(
-        self, hass: HomeAssistant, host: str = "0.0.0.0", port: int = 8901
+        self,
+        hass: HomeAssistant,
+        host: str = "0.0.0.0",
+        port: int = 8901,
+        max_connections: int = MAX_CONNECTIONS,
+        udp_port: int | None = None,
+        decode_workers: int = 0,
     ) -> None:
         self.host: str = host
         self.port: int = port
+        self.udp_port: int | None = udp_port
+        self.udp_transport: asyncio.DatagramTransport | None = None
         self.hass: HomeAssistant = hass
-        ESPSimpleStorage.init_storage(hass.config.config_dir)
-
-    def create_and_add_sensor(
-        self,
-        device: ESPSimpleDevice,
-        display_name: str,
-        unique_id: str,
-        unit_of_measurement: str,
-        device_class: SensorDeviceClass,
-        state_class: SensorStateClass,
+        self.server: asyncio.AbstractServer | None = None
+        self.max_connections: int = max_connections
+        self.clients: dict[
+            asyncio.Task, tuple[asyncio.StreamReader, asyncio.StreamWriter]
+        ] = dict()
+        # States waiting to be applied, by sensor
+        self.ingest: dict[ESPSimpleSensor, Any] = dict()
+        self.ingest_scheduled: bool = False
+        self.decode_workers: int = decode_workers
+        self.decode_pool: ESPSimpleDecodePool | None = None
+
+    def save_device(self, device: ESPSimpleDevice, delay: float | None = None) -> None:
+        """Schedules writing a device to storage"""
+        ESPSimpleStorage.async_schedule_save(self.hass, (device,), delay)
+
+    def create_sensor(
+        self, device: ESPSimpleDevice, sensor_id: str, registration: tuple
     ) -> ESPSimpleSensor:
-        """Creates and adds sensors"""
+        """Creates a sensor from its registration
+
+        registration is the reported name, unit, state class and device class.
+        """
+        display_name, unit, state_class, device_class = registration
         sensor: ESPSimpleSensor = ESPSimpleSensor(
             self.hass,
             ESPSimpleSensorInfo(
                 device.friendly_name + " " + display_name,
-                unique_id,
+                sensor_id,
                 device,
-                unit_of_measurement,
+                unit,
                 device_class,
                 state_class,
             ),
         )
+        sensor.info.fingerprint = hash(registration)
+        return sensor
 
-        device.add_sensor(sensor)
-        ESPSimpleStorage.set_devices(ESPSimpleDeviceRegistry.device_list)
+    def update_sensor(
+        self, device: ESPSimpleDevice, sensor: ESPSimpleSensor, registration: tuple
+    ) -> bool:
+        """Applies the registration of a known sensor
+
+        A registration with the fingerprint of the last one is skipped.
+        Returns whether the metadata changed.
+        """
+        fingerprint = hash(registration)
+        if fingerprint == sensor.info.fingerprint:
+            return False
+        sensor.info.fingerprint = fingerprint
+
+        display_name, unit, state_class, device_class = registration
+        if not sensor.info.update(
+            device.friendly_name + " " + display_name, unit, device_class, state_class
+        ):
+            return False
+        sensor.apply_info()
+        return True
+
+    async def send_ack(self, writer: asyncio.StreamWriter, code: int = ACK_OK) -> None:
+        """Sends an ack, only waits when the write buffer is full"""
+        writer.write(bytes([code]))
+        await writer.drain()
+
+    async def send_retry_after(
+        self, writer: asyncio.StreamWriter, seconds: float
+    ) -> None:
+        """Tells the device to drop back and send again after seconds"""
+        writer.write(bytes([ACK_RETRY_AFTER]) + retry_after_seconds(seconds))
+        await writer.drain()
+
+    def admission_wait(self, device: ESPSimpleDevice | None) -> float:
+        """Admits an update frame of a device
+
+        Returns 0 or the seconds the device has to wait because the ingest
+        queue is full or it is over its rate limit.
+        """
+        if len(self.ingest) >= INGEST_QUEUE_SIZE:
+            ESPSimpleMetrics.increment("updates_overloaded")
+            return OVERLOAD_RETRY_AFTER
+        if device is None:
+            return 0
+        wait = device.rate_limit.take(self.hass.loop.time())
+        if wait:
+            ESPSimpleMetrics.increment("updates_rate_limited")
+        return wait
+
+    def send_config(self, connection: ESPSimpleConnection) -> None:
+        """Sends the reporting settings of the attached device if they changed
+
+        Connections that never got settings are left alone, cleared
+        settings are sent as zeros, handing reporting back to the device.
+        """
+        if not connection.config_requested:
+            return
+        entries = connection.attached.reporting_config()
+        frame = encode_config(entries) if entries else None
+        if frame == connection.config:
+            return
+        connection.config = frame
+        connection.writer.write(frame or encode_config((("", 0, 0),)))
+        ESPSimpleMetrics.increment("configs_sent")
+
+    def push_config(self, device: ESPSimpleDevice) -> None:
+        """Pushes changed reporting settings to the connections of a device"""
+        for connection in device.connections:
+            self.send_config(connection)
+
+    def attach_connection(self, connection: ESPSimpleConnection, frame: Frame) -> None:
+        """Attaches a keep-alive connection to the device of a handled frame
+
+        Session connections belong to the authenticated device, plain ones
+        to the device id of the first frame naming one.
+        """
+        if connection.session is not None:
+            device = connection.device
+        elif frame.type in DEVICE_ID_FRAMES:
+            device = ESPSimpleDeviceRegistry.get_device(frame.fields[0])
+        else:
+            return
+        if device is None:
+            return
+        connection.attached = device
+        device.connections.add(connection)
+        self.send_config(connection)
+
+    def request_config(self, connection: ESPSimpleConnection) -> None:
+        """Sends FRAME_CONFIG to a connection from now on"""
+        connection.keep_alive = True
+        connection.config_requested = True
+        if connection.attached is not None:
+            self.send_config(connection)
+
+    def queue_update(self, sensor: ESPSimpleSensor, state: Any) -> None:
+        """Queues a reported state, replacing the one the sensor has waiting"""
+        if sensor in self.ingest:
+            ESPSimpleMetrics.increment("updates_merged")
+        self.ingest[sensor] = state
+        if not self.ingest_scheduled:
+            self.ingest_scheduled = True
+            self.hass.loop.call_soon(self.apply_ingest)
+
+    def apply_ingest(self) -> None:
+        """Applies the queued states"""
+        self.ingest_scheduled = False
+        ingest, self.ingest = self.ingest, dict()
+        for sensor, state in ingest.items():
+            self.apply_update(sensor, state)
+
+    def apply_update(self, sensor: ESPSimpleSensor, state: Any) -> bool:
+        """Sets a reported state unless the update filter drops it
+
+        The state is recorded for the state log, device metadata is not
+        written.
+        """
+        state = parse_state(state)
+        if not sensor.update_filter.accept(state, self.hass.loop.time()):
+            ESPSimpleMetrics.increment("updates_suppressed")
+            return False
+
+        with ESPSimpleMetrics.measure("set_state"):
+            sensor.set_state(state)
+        ESPSimpleStorage.async_schedule_state(
+            self.hass, sensor.info.handle, sensor.state_value
+        )
+        ESPSimpleMetrics.increment("updates_applied")
+        return True
 
-        return sensor
+    async def handle_registration(
+        self, writer: asyncio.StreamWriter, fields: tuple, with_handle: bool = False
+    ) -> bool | None:
+        """Handles sensor registration messages
 
-    def read_string(self, client) -> str:
-        length_data = client.recv(4)
-        if not length_data:
+        With with_handle the ack carries the handle of the sensor.
+        Returns False for malformed frames and None for rejected ones.
+        """
+        if not all(fields):
+            return False
+
+        device_id, sensor_id = fields[:2]
+
+        device = ESPSimpleDeviceRegistry.get_device(device_id)
+        if not device:
+            ESPSimpleMetrics.increment("registrations_unknown_device")
             return None
 
-        length = int.from_bytes(length_data, "little")
+        sensor: ESPSimpleSensor = device.get_sensor(sensor_id)
+        if not sensor:
+            sensor = self.create_sensor(device, sensor_id, fields[2:])
+            device.manifest_fingerprint = None
+            await device.async_add_sensors([sensor])
+            self.save_device(device, 0)
+        elif self.update_sensor(device, sensor, fields[2:]):
+            device.manifest_fingerprint = None
+            self.save_device(device)
+
+        if with_handle:
+            writer.write(bytes([ACK_OK]) + sensor.info.handle.to_bytes(4, "little"))
+            await writer.drain()
+        else:
+            await self.send_ack(writer)
+        return True
+
+    async def handle_manifest(
+        self, writer: asyncio.StreamWriter, fields: tuple
+    ) -> bool | None:
+        """Handles the registration of all sensors of a device
+
+        A manifest equal to the last one is acked from cache without
+        touching sensors, entities or storage. New sensors are added to
+        Home Assistant in one batch.
+        """
+        device_id, sensors = fields
+        if not device_id or not all(all(sensor) for sensor in sensors):
+            return False
 
-        string_data = client.recv(length)
-        if not length_data:
+        device = ESPSimpleDeviceRegistry.get_device(device_id)
+        if not device:
+            ESPSimpleMetrics.increment("registrations_unknown_device")
             return None
 
-        string = string_data.decode("utf-8")
+        fingerprint = hash(sensors)
+        if fingerprint != device.manifest_fingerprint:
+            added = dict()
+            changed = False
+            for registration in sensors:
+                sensor_id = registration[0]
+                sensor = device.get_sensor(sensor_id)
+                if sensor is None:
+                    if sensor_id not in added:
+                        added[sensor_id] = self.create_sensor(
+                            device, sensor_id, registration[1:]
+                        )
+                elif self.update_sensor(device, sensor, registration[1:]):
+                    changed = True
+            if added:
+                await device.async_add_sensors(list(added.values()))
+            if added or changed:
+                self.save_device(device, 0)
+
+            device.manifest_ack = bytes([ACK_OK]) + b"".join(
+                device.get_sensor(sensor[0]).info.handle.to_bytes(4, "little")
+                for sensor in sensors
+            )
+            device.manifest_fingerprint = fingerprint
+        else:
+            ESPSimpleMetrics.increment("manifests_unchanged")
 
-        return string
+        writer.write(device.manifest_ack)
+        await writer.drain()
+        return True
 
-    def handle_registration(self, client, addr) -> None:
-        """Handles sensor registration messages"""
-        device_id = self.read_string(client)
-        if not id:
+    def apply_device_updates(self, device_id: str, updates: tuple) -> None:
+        """Applies (sensor id, state) updates of a device"""
+        device = ESPSimpleDeviceRegistry.get_device(device_id)
+        if not device:
+            ESPSimpleMetrics.increment("updates_unknown_device")
             return
 
-        sensor_id = self.read_string(client)
-        if not sensor_id:
-            return
+        for sensor_id, state in updates:
+            sensor = device.get_sensor(sensor_id)
+            if not sensor:
+                ESPSimpleMetrics.increment("updates_unknown_sensor")
+                continue
+
+            self.queue_update(sensor, state)
+
+    def apply_handle_updates(
+        self, updates: tuple, device: ESPSimpleDevice | None = None
+    ) -> bool:
+        """Applies (handle, state) updates
+
+        With a device given, handles of other devices count as unknown.
+        Without, handles of devices requiring authentication do.
+        Returns False if any handle was unknown.
+        """
+        known = True
+        for handle, state in updates:
+            sensor = ESPSimpleDeviceRegistry.get_sensor_by_handle(handle)
+            if sensor is not None and sensor.info.device is not device:
+                # Handles of other devices and, for unauthenticated updates,
+                # of devices that require authentication
+                if device is not None or sensor.info.device.require_authentication:
+                    sensor = None
+            if sensor is None:
+                ESPSimpleMetrics.increment("updates_unknown_handle")
+                known = False
+                continue
+
+            self.queue_update(sensor, state)
+
+        return known
+
+    async def handle_device_update(
+        self, writer: asyncio.StreamWriter, frame: Frame
+    ) -> bool:
+        """Handles single and batched updates addressed by device and sensor id"""
+        parsed = device_updates(frame)
+        if parsed is None:
+            return False
+
+        device_id, updates = parsed
+        wait = self.admission_wait(ESPSimpleDeviceRegistry.get_device(device_id))
+        if wait:
+            await self.send_retry_after(writer, wait)
+            return True
+
+        if len(updates) == 1:
+            logging.info(
+                "Device "
+                + device_id
+                + " reported state "
+                + str(updates[0][1])
+                + " for uid "
+                + updates[0][0]
+            )
+        else:
+            logging.info(
+                "Device "
+                + device_id
+                + " reported "
+                + str(len(updates))
+                + " sensor states"
+            )
 
-        display_name = self.read_string(client)
-        if not display_name:
-            return
+        await self.send_ack(writer)
+        self.apply_device_updates(device_id, updates)
+        return True
 
-        unit = self.read_string(client)
-        if not unit:
+    async def handle_handle_update(
+        self,
+        writer: asyncio.StreamWriter,
+        frame: Frame,
+        device: ESPSimpleDevice | None = None,
+    ) -> bool:
+        """Handles single and batched state updates addressed by handle
+
+        Updates for unknown handles are dropped and acked with
+        ACK_UNKNOWN_HANDLE, telling the device to register again.
+        """
+        updates = handle_updates(frame)
+        limited = device
+        if limited is None and updates:
+            # Without a session the frame is limited by the device of its
+            # first sensor, unless the updates of that device are dropped
+            # anyway for lack of authentication
+            sensor = ESPSimpleDeviceRegistry.get_sensor_by_handle(updates[0][0])
+            if sensor is not None and not sensor.info.device.require_authentication:
+                limited = sensor.info.device
+        wait = self.admission_wait(limited)
+        if wait:
+            await self.send_retry_after(writer, wait)
+            return True
+
+        known = self.apply_handle_updates(updates, device)
+        await self.send_ack(writer, ACK_OK if known else ACK_UNKNOWN_HANDLE)
+        return True
+
+    def handle_datagram(self, data: bytes) -> None:
+        """Handles an update datagram
+
+        Layout: device id string, 8 byte sequence number, one update frame
+        and the HMAC-SHA256 of the datagram epoch and all of that keyed
+        with the device's encryption key. Sequence numbers have to increase
+        within the epoch, see FRAME_DATAGRAM_EPOCH. Without an open epoch
+        every datagram is dropped.
+        """
+        ESPSimpleMetrics.increment("datagrams")
+        view = memoryview(data)
+        if len(view) < 4 + 8 + 1 + DIGEST_SIZE or len(view) > MAX_FRAME_SIZE:
+            ESPSimpleMetrics.increment("datagrams_malformed")
             return
 
-        state_class = self.read_string(client)
-        if not state_class:
+        length = int.from_bytes(view[:4], "little")
+        header_end = 4 + length + 8
+        if not 0 < length <= MAX_FIELD_SIZE or header_end >= len(view) - DIGEST_SIZE:
+            ESPSimpleMetrics.increment("datagrams_malformed")
             return
 
-        device_class = self.read_string(client)
-        if not device_class:
+        try:
+            device_id = str(view[4 : 4 + length], "utf-8")
+        except UnicodeDecodeError:
+            ESPSimpleMetrics.increment("datagrams_malformed")
             return
 
         device = ESPSimpleDeviceRegistry.get_device(device_id)
-        if not device:
+        if device is None or not device.verify_signature(
+            view[:-DIGEST_SIZE], view[-DIGEST_SIZE:]
+        ):
+            ESPSimpleMetrics.increment("datagrams_unauthenticated")
             return
 
-        sensor: ESPSimpleSensor = device.get_sensor(device_id + "_" + sensor_id)
-        if not sensor:
-            sensor = self.create_and_add_sensor(
-                device, display_name, sensor_id, unit, device_class, state_class
-            )
-        else:
-            sensor.info.device_class = device_class
-            sensor.info.name = display_name
-            sensor.info.state_class = state_class
-            sensor.info.unit_of_measurement = unit
-
-        client.sendall(bytes([1]))
-
-    def handle_update(self, client, addr) -> None:
-        """Handles state updates"""
+        sequence = int.from_bytes(view[4 + length : header_end], "little")
+        if sequence <= device.udp_sequence:
+            ESPSimpleMetrics.increment("datagrams_replayed")
+            return
+        device.udp_sequence = sequence
+        if self.admission_wait(device):
+            ESPSimpleMetrics.increment("datagrams_dropped")
+            return
 
-        device_id = self.read_string(client)
-        if not device_id:
+        decoder = ESPSimpleFrameDecoder()
+        decoder.feed(view[header_end:-DIGEST_SIZE])
+        try:
+            frame = decoder.next_frame()
+        except FrameError:
+            frame = None
+        if frame is None or decoder.pending():
+            ESPSimpleMetrics.increment("datagrams_malformed")
             return
 
-        sensor_id = self.read_string(client)
-        if not sensor_id:
+        if frame.type in (FRAME_HANDLE_UPDATE, FRAME_HANDLE_BATCH_UPDATE):
+            self.apply_handle_updates(handle_updates(frame), device)
             return
 
-        state = self.read_string(client)
-        if not state:
+        parsed = device_updates(frame)
+        if parsed is None or parsed[0] != device_id:
+            # Registrations and other frames are only accepted over TCP
+            ESPSimpleMetrics.increment("datagrams_malformed")
             return
+        self.apply_device_updates(device_id, parsed[1])
+
+    async def handle_datagram_epoch(
+        self, writer: asyncio.StreamWriter, fields: tuple
+    ) -> bool | None:
+        """Opens a new datagram epoch for a device with a key"""
+        device = ESPSimpleDeviceRegistry.get_device(fields[0])
+        if device is None or device.auth_hmac is None:
+            await self.send_ack(writer, ACK_AUTH_FAILED)
+            return None
 
-        logging.info(
-            "Device " + device_id + " reported state " + state + " for uid " + sensor_id
+        writer.write(bytes([ACK_OK]) + device.open_udp_epoch())
+        await writer.drain()
+        return True
+
+    def authorized(self, device_id: str, device: ESPSimpleDevice | None) -> bool:
+        """Whether a frame for device_id is accepted
+
+        device is the device authenticated on the connection, if any.
+        """
+        if device is not None:
+            return device_id == device.device_id
+        target = ESPSimpleDeviceRegistry.get_device(device_id)
+        return target is None or not target.require_authentication
+
+    async def handle_auth_hello(
+        self, connection: ESPSimpleConnection, fields: tuple
+    ) -> bool | None:
+        """Starts a session, challenging the device with a nonce"""
+        device = ESPSimpleDeviceRegistry.get_device(fields[0])
+        if (
+            connection.server_nonce is not None
+            or device is None
+            or device.session_keys is None
+        ):
+            ESPSimpleMetrics.increment("auth_failures")
+            await self.send_ack(connection.writer, ACK_AUTH_FAILED)
+            return None
+
+        connection.device = device
+        connection.server_nonce = os.urandom(SESSION_NONCE_SIZE)
+        connection.keep_alive = True
+        connection.writer.write(bytes([ACK_OK]) + connection.server_nonce)
+        await connection.writer.drain()
+        return True
+
+    async def handle_auth_proof(
+        self, connection: ESPSimpleConnection, fields: tuple
+    ) -> bool | None:
+        """Opens the session if the device proved it knows its key"""
+        client_nonce, proof = fields
+        if (
+            connection.session is not None
+            or connection.server_nonce is None
+            or not connection.device.session_keys.verify_proof(
+                connection.server_nonce, client_nonce, proof
+            )
+        ):
+            ESPSimpleMetrics.increment("auth_failures")
+            await self.send_ack(connection.writer, ACK_AUTH_FAILED)
+            return None
+
+        connection.session = ESPSimpleSession(
+            connection.device.session_keys, connection.server_nonce, client_nonce
+        )
+        await self.send_ack(connection.writer)
+        connection.writer = ESPSimpleSealedWriter(
+            connection.writer, connection.session
         )
+        connection.records = ESPSimpleFrameDecoder()
+        ESPSimpleMetrics.increment("sessions")
+        return True
+
+    async def handle_sealed(
+        self, connection: ESPSimpleConnection, fields: tuple
+    ) -> bool | None:
+        """Opens a sealed record and handles the frame in it"""
+        try:
+            connection.records.feed(connection.session.open(fields[0]))
+            frame = connection.records.next_frame()
+        except FrameError as err:
+            logging.debug("Malformed record: " + str(err))
+            return False
+        if (
+            frame is None
+            or connection.records.pending()
+            or frame.type in SESSION_FRAMES
+        ):
+            return False
+
+        name = FRAME_NAMES.get(frame.type, "unknown")
+        ESPSimpleMetrics.increment("frames_" + name)
+        handled = await self.handle_frame(connection.writer, frame, connection.device)
+        if handled and frame.type == FRAME_CONFIG_REQUEST:
+            self.request_config(connection)
+        return handled
+
+    async def handle_connection_frame(
+        self, connection: ESPSimpleConnection, frame: Frame
+    ) -> bool | None:
+        """Handles a frame according to the session state of the connection"""
+        if frame.type == FRAME_AUTH_HELLO:
+            return await self.handle_auth_hello(connection, frame.fields)
+        if frame.type == FRAME_AUTH_PROOF:
+            return await self.handle_auth_proof(connection, frame.fields)
+        if connection.session is None:
+            if frame.type == FRAME_SEALED:
+                return None
+            handled = await self.handle_frame(connection.writer, frame)
+            if handled and frame.type == FRAME_CONFIG_REQUEST:
+                self.request_config(connection)
+            return handled
+        if frame.type != FRAME_SEALED:
+            # Plain frames on an encrypted connection may have been injected
+            return None
+        return await self.handle_sealed(connection, frame.fields)
 
-        client.sendall(bytes([1]))
+    async def handle_frame(
+        self,
+        writer: asyncio.StreamWriter,
+        frame: Frame,
+        device: ESPSimpleDevice | None = None,
+    ) -> bool | None:
+        """Handles a decoded frame
+
+        device is the device authenticated on the connection, if any.
+        Returns False for malformed frames and None for rejected ones.
+        """
+        if frame.type in DEVICE_ID_FRAMES and not self.authorized(
+            frame.fields[0], device
+        ):
+            ESPSimpleMetrics.increment("frames_unauthenticated")
+            return None
 
-        device = ESPSimpleDeviceRegistry.get_device(device_id)
-        if not device:
-            return
+        if frame.type == FRAME_REGISTRATION:
+            return await self.handle_registration(writer, frame.fields)
+        if frame.type == FRAME_HANDLE_REGISTRATION:
+            return await self.handle_registration(writer, frame.fields, True)
+        if frame.type == FRAME_MANIFEST:
+            return await self.handle_manifest(writer, frame.fields)
+        if frame.type == FRAME_CONFIG_REQUEST:
+            if ESPSimpleDeviceRegistry.get_device(frame.fields[0]) is None:
+                return None
+            await self.send_ack(writer)
+            return True
+        if frame.type == FRAME_DATAGRAM_EPOCH:
+            return await self.handle_datagram_epoch(writer, frame.fields)
+        if frame.type in (FRAME_HANDLE_UPDATE, FRAME_HANDLE_BATCH_UPDATE):
+            return await self.handle_handle_update(writer, frame, device)
+        if frame.type in DEVICE_UPDATE_FRAMES:
+            return await self.handle_device_update(writer, frame)
+        if frame.type == FRAME_KEEPALIVE:
+            await self.send_ack(writer)
+            return True
+        return None
+
+    async def handle_frames(
+        self, reader: asyncio.StreamReader, connection: ESPSimpleConnection
+    ) -> None:
+        """Reads frames until the connection is done"""
+        decoder = ESPSimpleFrameDecoder()
+        while True:
+            data = await asyncio.wait_for(reader.read(READ_SIZE), IDLE_TIMEOUT)
+            if not data:
+                return
+            decoder.feed(data)
+
+            if self.decode_pool is not None:
+                start = time.perf_counter()
+                frames, consumed, error = await self.decode_pool.decode(
+                    decoder.pending_data()
+                )
+                decoder.consume(consumed)
+                ESPSimpleMetrics.record("pool_decode", time.perf_counter() - start)
+                for frame in frames:
+                    if not await self.process_frame(connection, frame, start):
+                        return
+                if error is not None:
+                    ESPSimpleMetrics.increment("frames_malformed")
+                    logging.debug("Malformed frame: " + error)
+                    return
+                continue
 
-        sensor = device.get_sensor(device_id + "_" + sensor_id)
-        if not sensor:
-            return
+            while True:
+                start = time.perf_counter()
+                try:
+                    frame = decoder.next_frame()
+                except FrameError as err:
+                    ESPSimpleMetrics.increment("frames_malformed")
+                    logging.debug("Malformed frame: " + str(err))
+                    return
+                if frame is None:
+                    break
+                ESPSimpleMetrics.record("frame_parse", time.perf_counter() - start)
+
+                if not await self.process_frame(connection, frame, start):
+                    return
+
+    async def process_frame(
+        self, connection: ESPSimpleConnection, frame: Frame, start: float
+    ) -> bool:
+        """Handles a decoded frame, returns whether to read further frames"""
+        if frame.type == FRAME_KEEPALIVE:
+            connection.keep_alive = True
+        handled = await self.handle_connection_frame(connection, frame)
+        if handled and connection.keep_alive and connection.attached is None:
+            self.attach_connection(connection, frame)
+
+        name = FRAME_NAMES.get(frame.type, "unknown")
+        ESPSimpleMetrics.increment("frames_" + name)
+        if handled:
+            ESPSimpleMetrics.record("frame_" + name, time.perf_counter() - start)
+        elif handled is None:
+            ESPSimpleMetrics.increment("frames_rejected")
+        else:
+            ESPSimpleMetrics.increment("frames_malformed")
 
-        sensor.set_state(state)
-        ESPSimpleStorage.set_devices(ESPSimpleDeviceRegistry.device_list)
+        return bool(handled) and connection.keep_alive
 
-    def client_thread(self, client, addr) -> None:
-        """Client thread method"""
-        type = client.recv(1)
-        if not type:
+    async def handle_client(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        """Client connection handler"""
+        ESPSimpleMetrics.increment("connections")
+        if len(self.clients) >= self.max_connections:
+            ESPSimpleMetrics.increment("connections_rejected")
+            writer.write(
+                bytes([ACK_RETRY_AFTER]) + retry_after_seconds(OVERLOAD_RETRY_AFTER)
+            )
+            writer.close()
             return
 
-        if type[0] == 0:
-            self.handle_registration(client, addr)
+        task = asyncio.current_task()
+        self.clients[task] = (reader, writer)
+        connection = ESPSimpleConnection(writer)
+        try:
+            await self.handle_frames(reader, connection)
+        except ConnectionError as err:
+            ESPSimpleMetrics.increment("connection_errors")
+            logging.debug("Client connection failed: " + str(err))
+        except asyncio.TimeoutError:
+            ESPSimpleMetrics.increment("connection_timeouts")
+            logging.debug("Client connection timed out")
+        finally:
+            self.clients.pop(task, None)
+            if connection.attached is not None:
+                connection.attached.connections.discard(connection)
+            writer.close()
+
+    async def async_start(self) -> None:
+        """Start the server on the event loop
+
+        If the server or the datagram listener fail to bind, whatever was
+        started is stopped again and the error raised.
+        """
+        if self.decode_workers > 0:
+            self.decode_pool = ESPSimpleDecodePool(self.hass.loop, self.decode_workers)
+        try:
+            self.server = await asyncio.start_server(
+                self.handle_client,
+                self.host,
+                self.port,
+                backlog=ACCEPT_BACKLOG,
+                reuse_address=True,
+            )
+            await self.open_udp()
+        except OSError:
+            if self.server is not None:
+                self.server.close()
+                await self.server.wait_closed()
+                self.server = None
+            if self.decode_pool is not None:
+                pool, self.decode_pool = self.decode_pool, None
+                await self.hass.async_add_executor_job(pool.shutdown)
+            raise
+        logging.info("Socket server started")
 
-        if type[0] == 1:
-            self.handle_update(client, addr)
+    async def open_udp(self) -> None:
+        """Opens the datagram listener on udp_port, if set"""
+        if self.udp_port is None:
+            return
+        self.udp_transport, _ = await self.hass.loop.create_datagram_endpoint(
+            lambda: ESPSimpleDatagramProtocol(self),
+            local_addr=(self.host, self.udp_port),
+        )
 
-    def server_thread(self) -> None:
-        """Server Thread for accepting devices"""
-        logging.info("Socket server started")
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.bind((self.host, self.port))
-            s.listen()
-            while True:
-                conn, addr = s.accept()
-                client_thread = threading.Thread(
-                    target=self.client_thread, args=(conn, addr)
-                )
-                client_thread.start()
+    async def async_set_udp_port(self, udp_port: int | None) -> None:
+        """Moves the datagram listener to udp_port, None closes it
 
-    def start(self) -> None:
-        """Start the server"""
-        self.server_thread_obj = threading.Thread(target=self.server_thread)
-        self.server_thread_obj.start()
+        A stopped server opens it on start. If it fails to bind, the server
+        keeps running without it.
+        """
+        if udp_port == self.udp_port:
+            return
+        self.udp_port = udp_port
+        if self.server is None:
+            return
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+            self.udp_transport = None
+        try:
+            await self.open_udp()
+        except OSError as err:
+            self.udp_port = None
+            logging.warning("Datagram listener failed to start: " + str(err))
+
+    async def async_stop(self) -> None:
+        """Stop the server, draining open client connections
+
+        Connections stop reading and handle the frames already received,
+        those not done within DRAIN_TIMEOUT are closed. The reported states
+        are applied and written to storage.
+        """
+        if self.server is None:
+            return
+
+        self.server.close()
+        if self.udp_transport is not None:
+            self.udp_transport.close()
+            self.udp_transport = None
+        for reader, writer in self.clients.values():
+            writer.transport.pause_reading()
+            reader.feed_eof()
+        if self.clients:
+            _, pending = await asyncio.wait(self.clients, timeout=DRAIN_TIMEOUT)
+            for task in pending:
+                ESPSimpleMetrics.increment("connections_drain_timeouts")
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        await self.server.wait_closed()
+        self.server = None
+        self.apply_ingest()
+        await ESPSimpleStorage.async_flush(self.hass)
+        if self.decode_pool is not None:
+            pool, self.decode_pool = self.decode_pool, None
+            await self.hass.async_add_executor_job(pool.shutdown)
+        logging.info("Socket server stopped")
+
+    async def async_set_decode_workers(self, workers: int) -> None:
+        """Replaces the decode pool with one of workers processes
+
+        Connections waiting for the old pool get their buffers decoded on
+        the loop. A stopped server starts with the pool.
+        """
+        self.decode_workers = workers
+        if self.server is None:
+            return
+        pool = self.decode_pool
+        if (pool.workers if pool is not None else 0) == workers:
+            return
+        self.decode_pool = None
+        if workers > 0:
+            self.decode_pool = ESPSimpleDecodePool(self.hass.loop, workers)
+        if pool is not None:
+            await self.hass.async_add_executor_job(pool.shutdown)
+
+    def diagnostics(self) -> dict:
+        """Gets the state of the server for diagnostics"""
+        return {
+            "running": self.server is not None,
+            "active_connections": len(self.clients),
+            "ingest_queue": len(self.ingest),
+            "decode_workers": self.decode_workers if self.decode_pool else 0,
+        }
@@ -0,0 +1,116 @@
+"""ESP Simple Devices last state log
+
+Last states are kept apart from the device metadata in an append-only
+file of records, each a 4 byte little endian sensor handle followed by the
+typed state as sent on the wire. Later records of a handle replace earlier
+ones. Once the file has grown well beyond one record per sensor it is
+rewritten with only the latest records.
+
+The methods touching the file block, they run in the executor one at a
+time.
+"""
+import os
+from typing import Any
+
+from homeassistant.core import logging
+
+from .const import STATE_LOG_COMPACT_FACTOR, STATE_LOG_COMPACT_SIZE
+from .protocol import ESPSimpleFrameDecoder, FrameError, IncompleteFrame, encode_value
+
+
+class ESPSimpleStateLog:
+    """ESPSimpleStateLog"""
+
+    log_file: str = "/config/.storage/espsimple.states"
+    # Bytes in the log file and the size of its latest records
+    size: int = 0
+    live_size: int = 0
+
+    @staticmethod
+    def encode(records: dict) -> bytes:
+        """Encodes (handle: state) records"""
+        return b"".join(
+            handle.to_bytes(4, "little") + encode_value(state)
+            for handle, state in records.items()
+        )
+
+    @staticmethod
+    def load(log_file: str) -> dict:
+        """Reads the log in one sequential scan, returns the latest states
+
+        A torn record at the end, left by a write that did not finish, ends
+        the scan, the next compaction drops it. States are read without the
+        field size limit of the wire, they may have come from storage that
+        had none.
+        """
+        ESPSimpleStateLog.log_file = log_file
+        try:
+            with open(log_file, mode="rb") as f:
+                data = f.read()
+        except OSError:
+            data = b""
+
+        states = dict()
+        decoder = ESPSimpleFrameDecoder(len(data), len(data))
+        pos = 0
+        with memoryview(data) as view:
+            try:
+                while pos < len(view):
+                    handle, next_pos = decoder.read_uint(view, pos)
+                    states[handle], pos = decoder.read_value(view, next_pos)
+            except (IncompleteFrame, FrameError, UnicodeDecodeError):
+                pass
+
+        ESPSimpleStateLog.size = len(data)
+        ESPSimpleStateLog.live_size = len(ESPSimpleStateLog.encode(states))
+        if pos < len(data):
+            logging.warning(
+                "Dropping "
+                + str(len(data) - pos)
+                + " unreadable bytes at the end of the state log"
+            )
+            ESPSimpleStateLog.compact(states)
+        return states
+
+    @staticmethod
+    def needs_compaction() -> bool:
+        """Whether the log grew enough to be rewritten"""
+        return ESPSimpleStateLog.size > max(
+            STATE_LOG_COMPACT_SIZE,
+            ESPSimpleStateLog.live_size * STATE_LOG_COMPACT_FACTOR,
+        )
+
+    @staticmethod
+    def append(records: dict) -> None:
+        """Appends records to the log"""
+        data = ESPSimpleStateLog.encode(records)
+        try:
+            with open(ESPSimpleStateLog.log_file, mode="ab") as f:
+                f.write(data)
+                f.flush()
+        except OSError:
+            return None
+        ESPSimpleStateLog.size += len(data)
+
+    @staticmethod
+    def compact(states: dict) -> None:
+        """Rewrites the log with the latest states, replacing it atomically"""
+        data = ESPSimpleStateLog.encode(states)
+        temp_file = ESPSimpleStateLog.log_file + ".tmp"
+        try:
+            with open(temp_file, mode="wb") as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_file, ESPSimpleStateLog.log_file)
+        except OSError:
+            return None
+        ESPSimpleStateLog.size = ESPSimpleStateLog.live_size = len(data)
+
+    @staticmethod
+    def write(records: dict, states: Any = None) -> None:
+        """Appends records, or compacts to states when given"""
+        if states is not None:
+            ESPSimpleStateLog.compact(states)
+        else:
+            ESPSimpleStateLog.append(records)
@@ -0,0 +1,117 @@
+"""ESP Simple Devices update filtering"""
+from typing import Any
+
+from .const import (
+    CONF_ABSOLUTE_DELTA,
+    CONF_MAX_INTERVAL,
+    CONF_MIN_INTERVAL,
+    CONF_RELATIVE_DELTA,
+    CONF_REPORT_DEADBAND,
+    CONF_REPORT_INTERVAL,
+    CONF_SENSORS,
+    FILTER_OPTIONS,
+)
+
+
+def filter_settings(options: dict, sensor_id: str) -> dict:
+    """Gets the filter settings of a sensor from config entry options"""
+    settings = {key: options.get(key, 0) for key in FILTER_OPTIONS}
+    settings.update(options.get(CONF_SENSORS, dict()).get(sensor_id, dict()))
+    return settings
+
+
+def reporting_settings(options: dict, sensor_id: str | None = None) -> dict:
+    """Gets the reporting settings of a device or one of its sensors"""
+    settings = options
+    if sensor_id is not None:
+        settings = dict(options)
+        settings.update(options.get(CONF_SENSORS, dict()).get(sensor_id, dict()))
+    return {
+        CONF_REPORT_INTERVAL: float(settings.get(CONF_REPORT_INTERVAL, 0)),
+        CONF_REPORT_DEADBAND: float(settings.get(CONF_REPORT_DEADBAND, 0)),
+    }
+
+
+def as_number(value: Any) -> float | None:
+    """Converts a reported state to a number if possible"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class ESPSimpleUpdateFilter:
+    """Deadband and throttle for the updates of one sensor
+
+    An update passes if the value moved at least the absolute delta or the
+    relative delta (in percent) since the last accepted update. Updates
+    within the minimum interval are dropped, after the maximum interval an
+    update passes even if the value did not move. Settings of 0 disable the
+    respective check, with all of them 0 every update passes.
+    """
+
+    def __init__(self) -> None:
+        self.absolute_delta: float = 0
+        self.relative_delta: float = 0
+        self.min_interval: float = 0
+        self.max_interval: float = 0
+        self.enabled: bool = False
+        self.last_value: Any = None
+        self.last_time: float | None = None
+        self.accepted: int = 0
+        self.suppressed: int = 0
+
+    def configure(self, settings: dict) -> None:
+        """Applies filter settings"""
+        self.absolute_delta = float(settings.get(CONF_ABSOLUTE_DELTA, 0))
+        self.relative_delta = float(settings.get(CONF_RELATIVE_DELTA, 0))
+        self.min_interval = float(settings.get(CONF_MIN_INTERVAL, 0))
+        self.max_interval = float(settings.get(CONF_MAX_INTERVAL, 0))
+        self.enabled = any(
+            (
+                self.absolute_delta,
+                self.relative_delta,
+                self.min_interval,
+                self.max_interval,
+            )
+        )
+
+    def changed(self, value: Any) -> bool:
+        """Checks whether a value moved out of the deadband"""
+        if not self.absolute_delta and not self.relative_delta:
+            return True
+
+        new = as_number(value)
+        last = as_number(self.last_value)
+        if new is None or last is None:
+            return value != self.last_value
+
+        delta = abs(new - last)
+        if delta == 0:
+            return False
+        if self.absolute_delta and delta >= self.absolute_delta:
+            return True
+        if self.relative_delta and delta >= abs(last) * self.relative_delta / 100:
+            return True
+        return False
+
+    def accept(self, value: Any, now: float) -> bool:
+        """Checks whether an update should be applied, counts the result"""
+        if not self.enabled:
+            self.accepted += 1
+            return True
+
+        if self.last_time is not None:
+            elapsed = now - self.last_time
+            heartbeat = self.max_interval and elapsed >= self.max_interval
+            if not heartbeat and (
+                (self.min_interval and elapsed < self.min_interval)
+                or not self.changed(value)
+            ):
+                self.suppressed += 1
+                return False
+
+        self.last_value = value
+        self.last_time = now
+        self.accepted += 1
+        return True